@@ -5,81 +5,141 @@ Created on Fri Apr  8 19:02:23 2022
 @author: an553
 """
 
+import os
 import time
+import logging
 import numpy as np
+from collections import deque
 from scipy import linalg
+from concurrent.futures import ThreadPoolExecutor
+from essentials.checkpoint import save_checkpoint, load_checkpoint
+from essentials.Util import gaspari_cohn
+from essentials.operators import IndexOperator, MatrixOperator, stack_operators
+from essentials.instrumentation import Instrumentation, record, count
 
 rng = np.random.default_rng(6)
 
-
-def dataAssimilation(ensemble, y_obs, t_obs, std_obs=0.2, Nt_extra=None, **kwargs):
-
+# Messages of the assimilation loop: the progress is logged at the INFO level and the parameter checks at DEBUG.
+# The output is configured by the scripts that run the assimilation, e.g. with logging.basicConfig
+logger = logging.getLogger(__name__)
+
+
+def dataAssimilation(ensemble, y_obs, t_obs, std_obs=0.2, Nt_extra=None, obs_per_window=1,
+                     checkpoint_folder=None, checkpoint_every=10, resume_from=None, ensemble_size_policy=None,
+                     Cdd=None, smoother=None, analysis_trigger=None, **kwargs):
+    """ Sequential data assimilation of the observations y_obs at times t_obs. If obs_per_window > 1,
+        the asynchronous (4D) EnKF is used: the ensemble is forecast over windows containing
+        obs_per_window observations and a single analysis, at the last observation time of each window,
+        assimilates all of them using the ensemble observables stored at the observation times.
+        If checkpoint_folder is given, a checkpoint is saved every checkpoint_every analyses. Interrupted
+        runs are continued with resumeDataAssimilation. If an EnsembleSizePolicy is given, the ensemble
+        is resized after the analyses according to the forecast spread and innovation statistics.
+        The observation error covariance Cdd is defined from std_obs and the amplitude of y_obs if not given.
+        If a FixedLagSmoother is given, the analyses also update the states of its last windows.
+        If an AnalysisTrigger is given, the analyses with small innovations are skipped: the forecast continues
+        from the unchanged ensemble and the bias is updated with the forecast innovation.
+    """
     y_obs = y_obs.copy()
+    if obs_per_window > 1 and 'rBA' in ensemble.filter:
+        raise ValueError('Asynchronous assimilation not available for filter ' + ensemble.filter)
+
     # Print simulation parameters ##
     ensemble.print_model_parameters()
     ensemble.bias.print_bias_parameters()
     print_DA_parameters(ensemble, t_obs)
 
+    # Index of the observation at the end of each assimilation window
+    i_analysis = np.append(np.arange(obs_per_window - 1, len(t_obs) - 1, obs_per_window), len(t_obs) - 1)
+
+    # Index of the first analysis, which is not zero if the run is resumed from a checkpoint
+    ti = 0
+    if resume_from is not None:
+        if resume_from['obs_per_window'] != obs_per_window:
+            raise ValueError('Checkpoint saved with obs_per_window = {}'.format(resume_from['obs_per_window']))
+        ti = resume_from['ti']
+        if ensemble_size_policy is not None:
+            ensemble_size_policy.N_converged = resume_from.get('N_converged', 0)
+
     # FORECAST UNTIL FIRST OBS ##
+    ensemble.instrumentation = Instrumentation()
     time1 = time.time()
-    Nt = int(np.round((t_obs[0] - ensemble.get_current_time) / ensemble.dt))
+    Nt = int(np.round((t_obs[i_analysis[ti]] - ensemble.get_current_time) / ensemble.dt))
 
-    ensemble.number_of_analysis_steps = len(t_obs)
+    ensemble.number_of_analysis_steps = len(i_analysis)
 
     ensemble = forecastStep(ensemble, Nt, **kwargs)
 
     if ensemble.bias_bayesian_update and ensemble.bias.N_ens != ensemble.m:
         raise AssertionError('Wrong ESN initialisation')
 
-    print('Elapsed time to first observation: ' + str(time.time() - time1) + ' s')
+    logger.info('Elapsed time to first observation: ' + str(time.time() - time1) + ' s')
 
     #  ASSIMILATION LOOP ##
-    ti, ensemble.activate_bias_aware, ensemble.activate_parameter_estimation = 0, False, False
+    ensemble.activate_bias_aware, ensemble.activate_parameter_estimation = False, False
     time1 = time.time()
-    print_i = int(len(t_obs) / 10) * np.array([range(10)])
+    print_i = int(len(i_analysis) / 10) * np.array([range(10)])
 
     # Define observation covariance matrix
-    Cdd = np.diag((std_obs * np.ones(ensemble.Nq))) * np.max(abs(y_obs), axis=0) ** 2
+    if Cdd is None:
+        Cdd = np.diag((std_obs * np.ones(ensemble.Nq))) * np.max(abs(y_obs), axis=0) ** 2
+    Cdd_window = np.kron(np.eye(obs_per_window), Cdd)
+    # The perturbations are seeded from the ensemble generator, and the seed is kept to resume the run
+    if resume_from is None:
+        perturbation_seed = int(ensemble.rng.integers(2 ** 63))
+    else:
+        perturbation_seed = resume_from['perturbation_seed']
+    ensemble.perturbations = ObservationPerturbations(Cdd_window, ensemble.m, len(i_analysis), seed=perturbation_seed)
+    set_smoother(ensemble, smoother)
+    if resume_from is not None:
+        ensemble.perturbations.set_state(resume_from['perturbations'])
 
-    print('Assimilation progress: \n\t0 % ', end="")
+    logger.info('Assimilation progress: 0 %')
     while True:
+        ensemble.instrumentation.new_cycle(t=float(t_obs[i_analysis[ti]]))
         ensemble.activate_bias_aware = ti >= ensemble.num_DA_blind
         ensemble.activate_parameter_estimation = ti >= ensemble.num_SE_only
 
         # ------------------------------  PERFORM ASSIMILATION ------------------------------ #
-        Aa = analysisStep(ensemble, y_obs[ti], Cdd)  # Analysis step
-
-        # -------------------------  UPDATE STATE AND BIAS ESTIMATES------------------------- #
-        ensemble.update_history(Aa[:-ensemble.Nq, :], update_last_state=True)
-
-        # Update bias using the mean analysis innovation i^a = d - <y^a>
-        Ya = ensemble.get_observables()
-        ia = np.expand_dims(y_obs[ti], -1) - np.mean(Ya, -1, keepdims=True)
-
-        # Update the bias state
-        if not ensemble.bias.bayesian_update or ensemble.bias.name == 'NoBias':
-            updated_state = dict(b=ia)
+        i_window = np.arange(i_analysis[ti - 1] + 1 if ti > 0 else 0, i_analysis[ti] + 1)
+        if ensemble_size_policy is not None:
+            m_new = ensemble_size_policy.new_size(ensemble, y_obs[i_window[-1]], Cdd)  # From the forecast
+        if analysis_trigger is not None and not analysis_trigger.analyse(ensemble, y_obs[i_window[-1]], Cdd):
+            Aa = np.vstack((ensemble.get_current_state, ensemble.get_observables()))  # Keep the forecast
+            count(ensemble, 'skipped_analyses')
+        elif len(i_window) == 1:
+            Aa = analysisStep(ensemble, y_obs[i_window[-1]], Cdd)  # Analysis step
         else:
-            i_data = np.expand_dims(y_obs[ti], axis=-1) - np.mean(Ya, -1, keepdims=True)
-            u_hat, r_hat = ensemble.bias.reconstruct_state(i_data, Cdd=Cdd,
-                                                           inflation=ensemble.bias.inflation, update_reservoir=False)
+            # Stack the observations and the ensemble observables at the earlier times of the window
+            Y_window = get_window_observables(ensemble, t_obs[i_window[:-1]])
+            Nq_window = len(i_window) * ensemble.Nq
+            Aa = analysisStep(ensemble, y_obs[i_window].ravel(), Cdd_window[:Nq_window, :Nq_window],
+                              Y_window=Y_window.reshape(-1, ensemble.m))
+        ti_obs = i_window[-1]
 
-            if not ensemble.bias.update_reservoir:
-                updated_state = dict(b=u_hat)
-            else:
-                updated_state = dict(b=u_hat, r=r_hat)
-
-        ensemble.bias.update_history(**updated_state, update_last_state=True)
+        # -------------------------  UPDATE STATE AND BIAS ESTIMATES------------------------- #
+        t0 = time.perf_counter()
+        updateStep(ensemble, Aa, y_obs[ti_obs], Cdd)
+        if smoother is not None:
+            smoother.push(ensemble, Nt)
+        if ensemble_size_policy is not None:
+            resizeStep(ensemble, m_new)
+        record(ensemble, 'update', t0)
+
+        if checkpoint_folder is not None and (ti + 1) % checkpoint_every == 0 and ti + 1 < len(i_analysis):
+            save_checkpoint(ensemble, checkpoint_folder, ti + 1, rngs=dict(DA=rng, model=ensemble.rng),
+                            obs_per_window=obs_per_window, perturbations=ensemble.perturbations.get_state(),
+                            perturbation_seed=perturbation_seed,
+                            N_converged=getattr(ensemble_size_policy, 'N_converged', 0))
 
         # ------------------------------ FORECAST TO NEXT OBSERVATION ---------------------- #
         ti += 1
-        if ti >= len(t_obs):
-            print('100% ----------------\n')
+        if ti >= len(i_analysis):
+            logger.info('Assimilation progress: 100 %')
             break
         elif ti in print_i:
-            print(int(np.round(ti / len(t_obs) * 100, decimals=0)), end="% ")
+            logger.info('Assimilation progress: {} %'.format(int(np.round(ti / len(i_analysis) * 100, decimals=0))))
 
-        Nt = int(np.round((t_obs[ti] - ensemble.get_current_time) / ensemble.dt))
+        Nt = int(np.round((t_obs[i_analysis[ti]] - ensemble.get_current_time) / ensemble.dt))
         # Parallel forecast
         ensemble = forecastStep(ensemble, Nt)
 
@@ -90,15 +150,160 @@ def dataAssimilation(ensemble, y_obs, t_obs, std_obs=0.2, Nt_extra=None, **kwarg
         ensemble = forecastStep(ensemble, Nt=Nt_extra)
 
     
-    print('Elapsed time during assimilation: ' + str(time.time() - time1) + ' s')
+    logger.info('Elapsed time during assimilation: ' + str(time.time() - time1) + ' s')
+    if smoother is not None:
+        smoother.flush()
+    ensemble.perturbations, ensemble.smoother = None, None
     ensemble.close()
     return ensemble
 
 
+def multiDataAssimilation(ensemble, y_obs, t_obs, configs, std_obs=0.2, Nt_extra=None, **kwargs):
+    """ Data assimilation of the same observations with several filter configurations in lock-step, e.g. for
+        a sweep of the regularization factor k or the inflation. The forecast to the first observation is
+        shared. Then, the ensembles of all configurations are forecast together in one pool of processes,
+        the bias of each configuration is forecast by its own bias model, and the analyses are performed
+        together with stacked linear algebra. All configurations use the same stream of observation
+        perturbations, so that differences between them are not due to sampling.
+        Inputs:
+            ensemble: ensemble forecast as a class object, with the settings common to all configurations
+            configs: list of dictionaries of ensemble settings for each configuration, from
+                     filter ('EnKF' or 'rBA_EnKF'), regularization_factor, inflation, reject_inflation
+                     and num_DA_blind
+        Returns:
+            cases: list with the ensemble of each configuration
+    """
+    allowed = ['filter', 'regularization_factor', 'inflation', 'reject_inflation', 'num_DA_blind']
+    for config in configs:
+        if any(key not in allowed for key in config):
+            raise ValueError('Configurations can only modify {}'.format(allowed))
+        filt = config.get('filter', ensemble.filter)
+        if filt not in ['EnKF', 'rBA_EnKF']:
+            raise ValueError('Lock-step assimilation not available for filter ' + filt)
+
+    y_obs = y_obs.copy()
+    ensemble.print_model_parameters()
+    ensemble.bias.print_bias_parameters()
+    print_DA_parameters(ensemble, t_obs)
+
+    # FORECAST UNTIL FIRST OBS (SHARED) ##
+    time1 = time.time()
+    Nt = int(np.round((t_obs[0] - ensemble.get_current_time) / ensemble.dt))
+    ensemble = forecastStep(ensemble, Nt, **kwargs)
+    ensemble.close()
+    logger.info('Elapsed time to first observation: ' + str(time.time() - time1) + ' s')
+
+    Cdd = np.diag((std_obs * np.ones(ensemble.Nq))) * np.max(abs(y_obs), axis=0) ** 2
+
+    perturbation_seed = int(ensemble.rng.integers(2 ** 63))
+    cases = []
+    for config in configs:
+        case = ensemble.copy()
+        for key, val in config.items():
+            setattr(case, key, val)
+        case.number_of_analysis_steps = len(t_obs)
+        case.instrumentation = None
+        case.perturbations = ObservationPerturbations(Cdd, case.m, len(t_obs), seed=perturbation_seed)
+        cases.append(case)
+
+    # Model which forecasts the members of all configurations together
+    combined = ensemble.copy()
+    combined.bias = None
+    combined.m = ensemble.m * len(cases)
+
+    time1 = time.time()
+    print_i = int(len(t_obs) / 10) * np.array([range(10)])
+    logger.info('Assimilation progress: 0 %')
+    ti = 0
+    while True:
+        # ------------------------------  PERFORM ASSIMILATIONS ------------------------------ #
+        Af, D, B, J, k, ds = [], [], [], [], [], []
+        for case in cases:
+            case.activate_bias_aware = ti >= case.num_DA_blind
+            case.activate_parameter_estimation = ti >= case.num_SE_only
+            d = y_obs[ti].copy()
+            Af_case, M = get_augmented_forecast(case)
+            if case.filter == 'rBA_EnKF':
+                b, J_case = get_bias_terms(case, d)
+            if case.filter == 'rBA_EnKF' and case.activate_bias_aware:
+                B.append(np.repeat(b, case.m, axis=1) if b.shape[-1] == 1 else b)
+                J.append(J_case)
+                k.append(case.regularization_factor)
+            else:  # EnKF
+                B.append(np.zeros((case.Nq, case.m)))
+                J.append(np.zeros((case.Nq, case.Nq)))
+                k.append(0.)
+            Af.append(Af_case)
+            D.append(case.perturbations.draw(d))
+            ds.append(d)
+
+        Aa = rBA_EnKF_batch(np.array(Af), np.array(D), Cdd, Cdd, np.array(k), M, np.array(B), np.array(J))
+
+        # -------------------------  UPDATE STATE AND BIAS ESTIMATES------------------------- #
+        for case, Af_case, Aa_case, d in zip(cases, Af, Aa, ds):
+            Aa_case = postAnalysisStep(case, Af_case, Aa_case, d)
+            updateStep(case, Aa_case, d, Cdd)
+
+        # ------------------------------ FORECAST TO NEXT OBSERVATION ---------------------- #
+        ti += 1
+        if ti >= len(t_obs):
+            logger.info('Assimilation progress: 100 %')
+            break
+        elif ti in print_i:
+            logger.info('Assimilation progress: {} %'.format(int(np.round(ti / len(t_obs) * 100, decimals=0))))
+
+        Nt = int(np.round((t_obs[ti] - cases[0].get_current_time) / ensemble.dt))
+        multiForecastStep(cases, combined, Nt)
+
+    if Nt_extra is not None:
+        multiForecastStep(cases, combined, Nt_extra)
+
+    logger.info('Elapsed time during assimilation: ' + str(time.time() - time1) + ' s')
+    combined.close()
+    for case in cases:
+        case.perturbations = None
+    return cases
+
+
+def multiForecastStep(cases, combined, Nt):
+    """ Forecast the ensembles of several configurations with a single pool of processes, and then the
+        bias of each configuration
+    """
+    m = cases[0].m
+    combined.hist = np.concatenate([case.get_current_state for case in cases], axis=-1)[np.newaxis]
+    combined.hist_t = np.array([cases[0].get_current_time])
+    psi, t = combined.time_integrate(Nt)
+
+    for ii, case in enumerate(cases):
+        case.update_history(psi[..., ii * m:(ii + 1) * m], t)
+        y = case.get_observable_hist(Nt)
+        b, t_b = case.bias.time_integrate(t=t, y=y)
+        case.bias.update_history(b, t_b)
+
+
+def resumeDataAssimilation(ensemble, y_obs, t_obs, checkpoint_folder, load_history=False, **kwargs):
+    """ Resume an interrupted dataAssimilation run from the latest checkpoint in checkpoint_folder. The
+        ensemble must be created (and its bias model trained) with the same settings as the original run,
+        and y_obs, t_obs and the keyword arguments must be the same.
+    """
+    checkpoint = load_checkpoint(ensemble, checkpoint_folder, rngs=dict(DA=rng, model=ensemble.rng),
+                                 load_history=load_history)
+    logger.info('Resume assimilation from analysis {} at t = {}'.format(checkpoint['ti'], ensemble.get_current_time))
+    return dataAssimilation(ensemble, y_obs, t_obs, checkpoint_folder=checkpoint_folder, resume_from=checkpoint,
+                            **kwargs)
+
+
+def get_window_observables(case, t):
+    """ Ensemble observables at the past times t of the current forecast window [len(t) x Nq x m] """
+    Nt_back = np.round((case.get_current_time - t) / case.dt).astype(int)
+    Y = case.get_observable_hist(Nt_back[0] + 1)
+    return Y[Nt_back[0] - Nt_back]
+
+
 # =================================================================================================================== #
 
 
-def forecastStep(case, Nt, **kwargs):
+def forecastStep(case, Nt, averaged=False, **kwargs):
     """ Forecast step in the data assimilation algorithm. The state vector of
         one of the ensemble members is integrated in time
         Inputs:
@@ -110,60 +315,126 @@ def forecastStep(case, Nt, **kwargs):
             case: updated case forecast Nt time steps
     """
 
+    # If the bias forecast does not require the physical forecast (e.g. ESN in closed-loop), run it
+    # in a separate thread while the ensemble is forecast by the pool of processes
+    bias_future = None
+    if case.bias is not None and getattr(case, 'concurrent_bias_forecast', False) \
+            and not case.bias.depends_on_forecast(**kwargs):
+        executor = ThreadPoolExecutor(max_workers=1)
+        bias_future = executor.submit(case.bias.time_integrate, t=case.get_forecast_times(Nt)[1:], **kwargs)
+        executor.shutdown(wait=False)
+
     # Forecast ensemble and update the history
-    psi, t = case.time_integrate(Nt)
+    t0 = time.perf_counter()
+    psi, t = case.time_integrate(Nt, averaged=averaged)
+    count(case, 'solver_steps', Nt if averaged else Nt * case.m)
+    count(case, 'pool_dispatches', case.m if case.ensemble and not averaged else 0)
 
     try:
         case.update_history(psi, t)
     except ValueError:
-        print(f"Solver didn't return a homogeneous psi. Check initial conditions and parameters")
+        logger.warning("Solver didn't return a homogeneous psi. Check initial conditions and parameters")
+    t0 = record(case, 'forecast', t0)
 
-    # Forecast ensemble bias and update its history
-    if case.bias is not None:
+    # Forecast ensemble bias and update its history (in concurrent mode, the time waiting for it)
+    if bias_future is not None:
+        b, t_b = bias_future.result()
+        case.bias.update_history(b, t_b)
+    elif case.bias is not None:
         y = case.get_observable_hist(Nt)
         b, t_b = case.bias.time_integrate(t=t, y=y, **kwargs)
         case.bias.update_history(b, t_b)
+    record(case, 'bias_forecast', t0)
 
     if case.hist_t[-1] != case.bias.hist_t[-1]:
         raise AssertionError('t assertion', case.hist_t[-1], case.bias.hist_t[-1])
     return case
 
 
-def analysisStep(case, d, Cdd):
+def resizeStep(case, m_new):
+    """ Resize the ensemble after the analysis, together with its bias and perturbation stream """
+    if m_new == case.m:
+        return
+    logger.info('Ensemble size {} -> {} at t = {}'.format(case.m, m_new, case.get_current_time))
+    W = resize_weights(case.m, m_new, case.rng)
+    case.resize_ensemble(W)
+    if getattr(case, 'perturbations', None) is not None:
+        case.perturbations.resize(m_new)
+    if getattr(case, 'smoother', None) is not None:
+        case.smoother.resize(W)
+    count(case, 'resizes')
+
+
+def updateStep(case, Aa, d, Cdd):
+    """ Update the state and bias estimates with the analysis ensemble
+        Inputs:
+            case: ensemble forecast as a class object
+            Aa: analysis ensemble
+            d: observation at time t
+            Cdd: observation error covariance matrix
+        Returns:
+            ia: mean analysis innovation
+    """
+    case.update_history(Aa[:-case.Nq, :], update_last_state=True)
+
+    # Update bias using the mean analysis innovation i^a = d - <y^a>
+    Ya = case.get_observables()
+    ia = np.expand_dims(d, -1) - np.mean(Ya, -1, keepdims=True)
+
+    # Update the bias state
+    if not case.bias.bayesian_update or case.bias.name == 'NoBias':
+        updated_state = dict(b=ia)
+    else:
+        u_hat, r_hat = case.bias.reconstruct_state(ia, Cdd=Cdd,
+                                                   inflation=case.bias.inflation, update_reservoir=False)
+
+        if not case.bias.update_reservoir:
+            updated_state = dict(b=u_hat)
+        else:
+            updated_state = dict(b=u_hat, r=r_hat)
+
+    case.bias.update_history(**updated_state, update_last_state=True)
+    return ia
+
+
+def analysisStep(case, d, Cdd, Y_window=None):
     """ Analysis step in the data assimilation algorithm. First, the ensemble
         is augmented with parameters and/or bias and/or state
         Inputs:
             case: ensemble forecast as a class object
-            d: observation at time t
+            d: observation at time t, preceded by the earlier observations of the window if Y_window is given
             Cdd: observation error covariance matrix
+            Y_window: (optional) stacked ensemble observables at the earlier observation times of the window
         Returns:
             Aa: analysis ensemble (or Af is Aa is not real)
     """
 
-    Af = case.get_current_state  # state matrix [modes + params] x m
-    M = case.M.copy()
     Cdd = Cdd.copy()
+    t0 = time.perf_counter()
 
-    if case.est_a and not case.activate_parameter_estimation:
-        Af = Af[:-case.Na, :]
-        M = M[:, :-case.Na]
+    Af, M = get_augmented_forecast(case)
+    N_f = len(Af)
+
+    # ---------- Asynchronous EnKF: augment with the observables at the earlier times --------- #
+    if Y_window is not None:
+        Nq_past = len(Y_window)
+        Af = np.vstack((Af, Y_window))
+        M = IndexOperator(np.concatenate([np.arange(N_f, N_f + Nq_past), M.idx]), N_f + Nq_past)
 
-    # --------------- Augment state matrix with biased Y --------------- #
-    y = case.get_observables()
-    Af = np.vstack((Af, y))
     # ======================== APPLY SELECTED FILTER ======================== #
     if case.filter == 'EnSRKF':
         Aa = EnSRKF(Af, d, Cdd, M)
     elif case.filter == 'EnKF':
-        Aa = EnKF(Af, d, Cdd, M)
+        Aa = EnKF(Af, perturbed_observations(case, d), Cdd, M)
+    elif case.filter == 'serial_EnKF':
+        C_loc = localisation_weights(case, N_f, len(d) // case.Nq)
+        Aa = serial_EnKF(Af, perturbed_observations(case, d), Cdd, M,
+                         batch_size=case.obs_batch_size, C_loc=C_loc)
+    elif case.filter == 'LETKF':
+        C_loc = localisation_weights(case, N_f, len(d) // case.Nq)
+        Aa = LETKF(Af, d, Cdd, M, C_loc=C_loc, num_threads=case.num_processes)
     elif 'rBA' in case.filter:
-        # ----------------- Retrieve bias and its Jacobian ----------------- #
-        b = case.bias.get_current_bias
-        J = case.bias.state_derivative()
-
-        if case.bias.biased_observations:
-            bd = np.mean(b - case.bias.get_current_innovations, axis=-1)
-            d += bd
+        b, J = get_bias_terms(case, d)
 
         # -------------- Define bias Covariance and the weight -------------- #
         k = case.regularization_factor
@@ -171,17 +442,70 @@ def analysisStep(case, d, Cdd):
 
         if case.activate_bias_aware:
             if case.filter == 'rBA_EnKF':
-                Aa = rBA_EnKF(Af, d, Cdd, Cbb, k, M, b, J)
+                Aa = rBA_EnKF(Af, perturbed_observations(case, d), Cdd, Cbb, k, M, b, J)
             elif case.filter == 'rBA_EnKF_CMAME':
-                Aa = rBA_EnKF_CMAME(Af, d, Cdd, Cbb, k, M, b, J)
+                Aa = rBA_EnKF_CMAME(Af, perturbed_observations(case, d), Cdd, Cbb, k, M, b, J)
+            elif case.filter == 'rBA_EnSRKF':
+                Aa = rBA_EnSRKF(Af, d, Cdd, Cbb, k, M, b, J)
             else:
                 raise ValueError('Filter ' + case.filter + ' not defined.')
 
+        elif case.filter == 'rBA_EnSRKF':
+            Aa = EnSRKF(Af, d, Cdd, M)
         else:
-            Aa = EnKF(Af, d, Cdd, M)
+            Aa = EnKF(Af, perturbed_observations(case, d), Cdd, M)
     else:
         raise ValueError('Filter ' + case.filter + ' not defined.')
 
+    if Y_window is not None:
+        Af, Aa, d = Af[:N_f], Aa[:N_f], d[-case.Nq:]
+    record(case, 'analysis', t0)
+    count(case, 'analyses')
+
+    return postAnalysisStep(case, Af, Aa, d)
+
+
+def get_augmented_forecast(case):
+    """ Forecast state matrix [modes + params] x m augmented with the observables, and the map M from the
+        augmented state to the observables. The parameters are excluded until parameter estimation starts.
+    """
+    Af = case.get_current_state
+    M = case.M
+
+    if case.est_a and not case.activate_parameter_estimation:
+        Af = Af[:-case.Na, :]
+        M = IndexOperator(M.idx - case.Na, M.N - case.Na)
+
+    # --------------- Augment state matrix with biased Y --------------- #
+    y = case.get_observables()
+    Af = np.vstack((Af, y))
+    return Af, M
+
+
+def get_bias_terms(case, d):
+    """ Retrieve the bias and its Jacobian. If the bias model is trained on biased observations,
+        the observation d is corrected in place with the mean bias of the innovations.
+    """
+    b = case.bias.get_current_bias
+    J = case.bias.state_derivative()
+
+    if case.bias.biased_observations:
+        bd = np.mean(b - case.bias.get_current_innovations, axis=-1)
+        d += bd
+    return b, J
+
+
+def postAnalysisStep(case, Af, Aa, d):
+    """ Check that the estimated parameters are physical and inflate the analysis ensemble
+        Inputs:
+            case: ensemble forecast as a class object
+            Af: augmented forecast ensemble
+            Aa: analysis ensemble
+            d: observation at time t
+        Returns:
+            Aa: analysis ensemble, or the inflated forecast if the analysis is rejected
+    """
+    t0 = time.perf_counter()
     # ============================ CHECK PARAMETERS AND INFLATE =========================== #
     if case.est_a:
         if not case.activate_parameter_estimation:
@@ -191,16 +515,18 @@ def analysisStep(case, d, Cdd):
         else:
             is_physical, idx_alpha, d_alpha = checkParams(Aa, case)
             if is_physical:
+                smooth_past_states(case, Af, Aa)
                 Aa = inflateEnsemble(Aa, case.inflation, case.Na)
             else:
                 case.is_not_physical()  # Count non-physical parameters
+                count(case, 'rejected_analyses')
                 if not hasattr(case, 'rejected_analysis'):
                     case.rejected_analysis = []
                 if not case.constrained_filter:
                     # print('reject-inflate')
                     Aa = inflateEnsemble(Af, case.reject_inflation, case.Na, d=d, additive=True)
                     case.rejected_analysis.append([(case.get_current_time,
-                                                    np.dot(case.Ma, Aa), np.dot(case.Ma, Af),
+                                                    case.Ma @ Aa, case.Ma @ Af,
                                                     None)])
                 else:
                     raise NotImplementedError('Constrained filter yet to test')
@@ -233,10 +559,60 @@ def analysisStep(case, d, Cdd):
                     #     print('! not ok c-filter case')
                     #     Aa = inflateEnsemble(Af, case.inflation)
     else:
+        smooth_past_states(case, Af, Aa)
         Aa = inflateEnsemble(Aa, case.inflation,case.Na,  d=d, additive=True)
+    record(case, 'inflation', t0)
     return Aa
 
 
+def set_smoother(case, smoother):
+    """ Attach the smoother to the case. The smoother applies a single m x m transform per analysis, which the
+        localised filters (serial_EnKF and LETKF with a localisation radius) do not have, so they are rejected.
+    """
+    if smoother is not None and case.filter in ['serial_EnKF', 'LETKF'] and \
+            localisation_weights(case, case.N) is not None:
+        raise ValueError('The smoother is not available for the localised {} analysis'.format(case.filter))
+    case.smoother = smoother
+
+
+def smooth_past_states(case, Af, Aa):
+    """ Apply the (accepted, not inflated) analysis to the past windows of the smoother of the case, if any """
+    if getattr(case, 'smoother', None) is not None:
+        case.smoother.set_analysis(Af, Aa)
+
+
+def localisation_weights(case, N_f, K=1):
+    """ Gaspari-Cohn weights between the rows of the augmented forecast and the observations, given by the
+        distance between microphones. The parameters are global and not localised, and so is the state unless
+        the model defines state_locations (NaN for global states). With K > 1, the forecast is augmented with
+        the observables at the K - 1 earlier times of the window.
+        Returns:
+            C_loc: localisation weights [N x Nq K], or None if there is no localisation
+    """
+    loc = case.obs_locations
+    if case.localisation_radius is None or loc is None:
+        return None
+    rho = gaspari_cohn(case.obs_distance(loc, loc), case.localisation_radius)
+    C_state = np.ones((N_f - case.Nq, case.Nq))
+    state_loc = case.state_locations
+    if state_loc is not None:
+        local = np.flatnonzero(~np.isnan(state_loc))
+        C_state[local] = gaspari_cohn(case.obs_distance(state_loc[local], loc), case.localisation_radius)
+    C_loc = np.vstack([np.tile(C_state, (1, K)),
+                       np.tile(rho, (1, K)),
+                       np.tile(rho, (K - 1, K))])
+    return C_loc
+
+
+def perturbed_observations(case, d):
+    """ Ensemble of perturbed observations from the pre-drawn stream of the case, if any. Otherwise
+        the filters perturb d themselves.
+    """
+    if getattr(case, 'perturbations', None) is None:
+        return d
+    return case.perturbations.draw(d)
+
+
 # =================================================================================================================== #
 def inflateEnsemble(A, rho, Na, d=None, additive=True):
     if d is not None and additive is False:
@@ -262,14 +638,11 @@ def check_std_too_large(A, Na):
     return bool(sum(condition > 1.))
 
 def checkParams(Aa, case):
-    alphas, lower_bounds, upper_bounds, ii = [], [], [], 0
+    alphas, lower_bounds, upper_bounds = list(case.Ma @ Aa), [], []
     for param in case.est_a:
         lims = case.alpha_lims[param]
-        vals = Aa[case.Nphi + ii, :]
         lower_bounds.append(lims[0])
         upper_bounds.append(lims[1])
-        alphas.append(vals)
-        ii += 1
 
     break_low = [lims is not None and any(val < lims) for val, lims in zip(alphas, lower_bounds)]
     break_up = [lims is not None and any(val > lims) for val, lims in zip(alphas, upper_bounds)]
@@ -289,13 +662,11 @@ def checkParams(Aa, case):
                 mean_, min_ = np.mean(alpha_), np.min(alpha_)
                 bound_ = lower_bounds[idx_]
                 if mean_ >= bound_:
-                    # print('t = {:.3f} r-i: min {} = {:.2e} < {:.2e}'.format(case.get_current_time,
-                    #                                                         case.est_a[idx_], min_, bound_))
-                    print('!', end="")
+                    logger.debug('t = {:.3f} r-i: min {} = {:.2e} < {:.2e}'.format(case.get_current_time,
+                                                                                   case.est_a[idx_], min_, bound_))
                 else:
-                    # print('t = {:.3f} r-i: mean {} = {:.2e} < {:.2e}'.format(case.get_current_time,
-                    #                                                          case.est_a[idx_], mean_, bound_))
-                    print('!', end="")
+                    logger.debug('t = {:.3f} r-i: mean {} = {:.2e} < {:.2e}'.format(case.get_current_time,
+                                                                                    case.est_a[idx_], mean_, bound_))
         if any(break_up):
             idx = np.argwhere(break_up)
             if len(idx.shape) > 1:
@@ -305,13 +676,11 @@ def checkParams(Aa, case):
                 mean_, max_ = np.mean(alpha_), np.max(alpha_)
                 bound_ = upper_bounds[idx_]
                 if mean_ <= bound_:
-                    # print('t = {:.3f} r-i: max {} = {:.2e} > {:.2e}'.format(case.get_current_time,
-                    #                                                         case.est_a[idx_], max_, bound_))
-                    print('!', end="")
+                    logger.debug('t = {:.3f} r-i: max {} = {:.2e} > {:.2e}'.format(case.get_current_time,
+                                                                                   case.est_a[idx_], max_, bound_))
                 else:
-                    # print('t = {:.3f} r-i: mean {} = {:.2e} > {:.2e}'.format(case.get_current_time,
-                    #                                                          case.est_a[idx_], mean_, bound_))
-                    print('!', end="")
+                    logger.debug('t = {:.3f} r-i: mean {} = {:.2e} > {:.2e}'.format(case.get_current_time,
+                                                                                    case.est_a[idx_], mean_, bound_))
         return is_physical, None, None
 
     #  -----------------------------------------------------------------
@@ -326,14 +695,12 @@ def checkParams(Aa, case):
             if mean_ >= bound_:
                 d_alpha.append(np.max(alpha_) + np.std(alpha_))
 
-                # print('t = {:.3f}: min{}={:.2f}<{:.2e}. d_alph={:.2e}'.format(case.get_current_time, case.est_a[idx_],
-                #                                                               min_, bound_, d_alpha[-1]))
-                print('!', end="")
+                logger.debug('t = {:.3f}: min{}={:.2f}<{:.2e}. d_alph={:.2e}'.format(case.get_current_time, case.est_a[idx_],
+                                                                                     min_, bound_, d_alpha[-1]))
             else:
                 d_alpha.append(bound_ + 2 * np.std(alphas[idx_]))
-                # print('t = {:.3f}: mean{}={:.2f}<{:.2e}. d_alph={:.2e}'.format(case.get_current_time, case.est_a[idx_],
-                #                                                                mean_, bound_, d_alpha[-1]))
-                print('!', end="")
+                logger.debug('t = {:.3f}: mean{}={:.2f}<{:.2e}. d_alph={:.2e}'.format(case.get_current_time, case.est_a[idx_],
+                                                                                      mean_, bound_, d_alpha[-1]))
 
     if any(break_up):
         idx = np.argwhere(break_up)
@@ -352,15 +719,13 @@ def checkParams(Aa, case):
                 d_alpha.append(np.min(alpha_) - np.std(alpha_))
                 # elif min_ < bound_:
                 #     d_alpha.append(min_)
-                # print('t = {:.3f}: max{}={:.2e}>{:.2e}. d_alph={:.2e}'.format(case.get_current_time, case.est_a[idx_],
-                #                                                               max_, bound_, d_alpha[-1]))
-                print('!', end="")
+                logger.debug('t = {:.3f}: max{}={:.2e}>{:.2e}. d_alph={:.2e}'.format(case.get_current_time, case.est_a[idx_],
+                                                                                     max_, bound_, d_alpha[-1]))
             else:
                 d_alpha.append(bound_ - 2 * np.std(alphas[idx_]))
 
-                # print('t = {:.3f}: mean{}={:.2e}>{:.2e}. d_alph={:.2e}'.format(case.get_current_time, case.est_a[idx_],
-                #                                                                mean_, bound_, d_alpha[-1]))
-                print('!', end="")
+                logger.debug('t = {:.3f}: mean{}={:.2e}>{:.2e}. d_alph={:.2e}'.format(case.get_current_time, case.est_a[idx_],
+                                                                                      mean_, bound_, d_alpha[-1]))
 
     return is_physical, np.array(idx_alpha, dtype=int), d_alpha
 
@@ -370,49 +735,111 @@ def checkParams(Aa, case):
 
 
 def EnSRKF(Af, d, Cdd, M):
-    """Ensemble Square-Root Kalman Filter based on Evensen (2009)
+    """Ensemble Square-Root Kalman Filter in its ensemble-transform form (ETKF, Hunt et al. 2007), which
+        has the same analysis mean and symmetric square-root deviations as Evensen (2009). It requires a
+        single symmetric eigen-decomposition of size min(Nq, m).
         Inputs:
             Af: forecast ensemble at time t
             d: observation at time t
             Cdd: observation error covariance matrix
-            M: matrix mapping from state to observation space
+            M: operator mapping from state to observation space
         Returns:
-            Aa: analysis ensemble (or Af is Aa is not real)
+            Aa: analysis ensemble
     """
-    m = np.size(Af, 1)  # ensemble size
-    d = np.expand_dims(d, axis=1)
+    if d.ndim == 1:
+        d = np.expand_dims(d, axis=1)
     psi_f_m = np.mean(Af, 1, keepdims=True)
     Psi_f = Af - psi_f_m
 
     # Mapped mean and deviations
-    y = np.dot(M, psi_f_m)
-    S = np.dot(M, Psi_f)
+    y = M @ psi_f_m
+    S = M @ Psi_f
 
-    # Matrix to invert
-    C = (m - 1) * Cdd + np.dot(S, S.T)
-    L, Z = linalg.eig(C)
-    Linv = linalg.inv(np.diag(L.real))
+    # Whitened deviations X = Cdd^-1/2 S and innovations z = Cdd^-1/2 (d - y)
+    w, T = ensemble_transform(cov_whiten(Cdd, S), cov_whiten(Cdd, d - y))
 
-    X2 = np.dot(linalg.sqrtm(Linv), np.dot(Z.T, S))
-    E, V = linalg.svd(X2)[1:]
-    V = V.T
-    if len(E) is not m:  # case for only one eigenvalue (q=1). The rest zeros.
-        E = np.hstack((E, np.zeros(m - len(E))))
-    E = np.diag(E.real)
+    # Analysis mean and deviations with the symmetric square-root transform T = [I + X^T X / (m-1)]^-1/2
+    psi_a_m = psi_f_m + np.dot(Psi_f, w)
+    Psi_a = np.dot(Psi_f, T)
 
-    sqrtIE = linalg.sqrtm(np.eye(m) - np.dot(E.T, E))
+    return psi_a_m + Psi_a
 
-    # Analysis mean
-    Cm = np.dot(Z, np.dot(Linv, Z.T))
-    psi_a_m = psi_f_m + np.dot(Psi_f, np.dot(S.T, np.dot(Cm, (d - y))))
 
-    # Analysis deviations
-    Psi_a = np.dot(Psi_f, np.dot(V, np.dot(sqrtIE, V.T)))
-    Aa = psi_a_m + Psi_a
+def ensemble_transform(X, z):
+    """ Weights w of the analysis mean and symmetric square-root transform T = [I + X^T X / (m-1)]^-1/2 of the
+        ETKF, from the whitened mapped deviations X [Nq x m] and innovations z [Nq x 1]. They only need the
+        eigen-decomposition of X^T X, which has rank min(Nq, m) and is obtained from the smaller Gram matrix.
+    """
+    m = np.size(X, 1)
+    a = m - 1
+    if np.size(X, 0) < m:
+        # X X^T = U diag(L) U^T. Then X^T X has eigenvectors X^T U L^-1/2 and the rest of eigenvalues are zero
+        L, U = linalg.eigh(np.dot(X, X.T))
+        L = np.maximum(L, 0.)
+        XtU = np.dot(X.T, U)
+        w = np.dot(XtU, np.dot(U.T, z) / (a + L)[:, np.newaxis])
+        T = np.eye(m) - np.dot(XtU / (np.sqrt(a + L) * (np.sqrt(a) + np.sqrt(a + L))), XtU.T)
+    else:
+        # X^T X = V diag(L) V^T
+        L, V = linalg.eigh(np.dot(X.T, X))
+        L = np.maximum(L, 0.)
+        w = np.dot(V, np.dot(V.T, np.dot(X.T, z)) / (a + L)[:, np.newaxis])
+        T = np.dot(V * np.sqrt(a / (a + L)), V.T)
+    return w, T
+
+
+def LETKF(Af, d, Cdd, M, C_loc=None, num_threads=None):
+    """Local Ensemble Transform Kalman Filter (Hunt et al. 2007). Each row of the forecast is updated by a local
+        ETKF in ensemble space, in which the observations are weighted by its localisation weights C_loc
+        (i.e., Cdd^-1 is localised). Rows with the same weights, such as the global states and parameters,
+        share one local analysis, and the local analyses are computed in parallel by num_threads threads.
+        Without C_loc, it is the EnSRKF.
+        Inputs:
+            Af: forecast ensemble at time t
+            d: observation at time t
+            Cdd: observation error covariance matrix
+            M: operator mapping from state to observation space
+            C_loc: (optional) localisation weights [N x Nq]
+            num_threads: number of threads (all the CPUs by default)
+        Returns:
+            Aa: analysis ensemble
+    """
+    if d.ndim == 1:
+        d = np.expand_dims(d, axis=1)
+    psi_f_m = np.mean(Af, 1, keepdims=True)
+    Psi_f = Af - psi_f_m
 
-    if not np.isreal(Aa).all():
-        Aa = Af
-        print('Aa not real')
+    if C_loc is None:
+        rows, weights = [np.arange(len(Af))], np.ones((1, len(d)))
+    elif np.count_nonzero(Cdd - np.diag(np.diagonal(Cdd))) > 0:
+        raise ValueError('Localisation of the LETKF requires uncorrelated observation errors')
+    else:
+        # Rows with the same localisation weights share the local analysis
+        groups = dict()
+        for i, rho in enumerate(C_loc):
+            groups.setdefault(rho.tobytes(), []).append(i)
+        rows = [np.array(idx) for idx in groups.values()]
+        weights = C_loc[[idx[0] for idx in rows]]
+    X = cov_whiten(Cdd, M @ Psi_f)
+    z = cov_whiten(Cdd, d - M @ psi_f_m)
+
+    Aa = Af.copy()
+
+    def local_analyses(groups):
+        for g in groups:
+            obs = np.flatnonzero(weights[g])
+            if len(obs) == 0:
+                continue
+            sqrt_rho = np.sqrt(weights[g, obs])[:, np.newaxis]
+            w, T = ensemble_transform(X[obs] * sqrt_rho, z[obs] * sqrt_rho)
+            Aa[rows[g]] = psi_f_m[rows[g]] + np.dot(Psi_f[rows[g]], T + w)
+
+    chunks = np.array_split(np.arange(len(weights)), min(len(weights), num_threads or os.cpu_count()))
+    if len(chunks) == 1:
+        local_analyses(chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            list(executor.map(local_analyses, chunks))
     return Aa
 
 
@@ -422,7 +849,7 @@ def EnKF(Af, d, Cdd, M):
             Af: forecast ensemble at time t
             d: observation at time t
             Cdd: observation error covariance matrix
-            M: matrix mapping from state to observation space
+            M: operator mapping from state to observation space
         Returns:
             Aa: analysis ensemble (or Af is Aa is not real)
     """
@@ -438,20 +865,78 @@ def EnKF(Af, d, Cdd, M):
         D = rng.multivariate_normal(d, Cdd, m).transpose()
 
     # Mapped forecast matrix M(Af) and mapped deviations M(Af')
-    Y = np.dot(M, Af)
-    S = np.dot(M, Psi_f)
+    Y = M @ Af
+    S = M @ Psi_f
 
-    # Matrix to invert
-    C = (m - 1) * Cdd + np.dot(S, S.T)
-    Cinv = linalg.inv(C)
-
-    X = np.dot(S.T, np.dot(Cinv, (D - Y)))
+    # Ensemble-space weights S^T [(m-1) Cdd + S S^T]^-1 (D - Y)
+    X = ensemble_weights(S, (m - 1) * Cdd, D - Y)
 
     Aa = Af + np.dot(Af, X)
 
     if not np.isreal(Aa).all():
         Aa = Af
-        print('Aa not real')
+        logger.warning('Aa not real')
+    return Aa
+
+
+def serial_EnKF(Af, d, Cdd, M, batch_size=1, C_loc=None):
+    """Ensemble Kalman Filter with serial processing of the observations (Houtekamer & Mitchell 2001).
+        The observations are assimilated in batches of batch_size, each updating the ensemble used by the
+        next, so only batch_size x batch_size systems are solved. The batches must have independent errors,
+        so correlated observation errors are whitened first. The gain can be localised with the weights
+        C_loc between the rows of Af and the observations, and then each batch only updates the rows within
+        its radius, which makes the cost linear in Nq.
+        Inputs:
+            Af: forecast ensemble at time t
+            d: observation at time t
+            Cdd: observation error covariance matrix
+            M: operator mapping from state to observation space
+            batch_size: number of observations assimilated at once
+            C_loc: (optional) localisation weights [N x Nq]
+        Returns:
+            Aa: analysis ensemble (or Af is Aa is not real)
+    """
+    m = np.size(Af, 1)
+    Nq = len(Cdd)
+
+    # Create an ensemble of observations
+    if d.ndim == 2 and d.shape[-1] == m:
+        D = d
+    else:
+        D = rng.multivariate_normal(d, Cdd, m).transpose()
+
+    if np.count_nonzero(Cdd - np.diag(np.diagonal(Cdd))) == 0:
+        c = np.diagonal(Cdd)
+    elif C_loc is None:
+        # Whitened observations L^-1 d of L^-1 M A, which have identity error covariance
+        D, M, c = cov_whiten(Cdd, D), MatrixOperator(cov_whiten(Cdd, np.eye(Nq)), inner=M), np.ones(Nq)
+    else:
+        raise ValueError('Localisation of the serial EnKF requires uncorrelated observation errors')
+
+    Aa = Af.copy()
+    rows = np.arange(len(Af))
+    for i0 in range(0, Nq, batch_size):
+        idx = slice(i0, min(i0 + batch_size, Nq))
+        # Only the rows within the localisation radius of the batch are updated
+        M_b = M[idx]
+        if C_loc is not None:
+            rows = np.flatnonzero(np.any(C_loc[:, idx], axis=1))
+
+        Y = M_b @ Aa
+        Psi = Aa[rows] - np.mean(Aa[rows], 1, keepdims=True)
+        S = Y - np.mean(Y, 1, keepdims=True)
+
+        # Gain K = Cxy (Cyy + Cdd)^-1 of the batch, with the localised covariances
+        Cxy, Cyy = np.dot(Psi, S.T), np.dot(S, S.T)
+        if C_loc is not None:
+            Cxy *= C_loc[rows, idx]
+            Cyy *= M_b @ C_loc[:, idx]
+        Cyy[np.diag_indices_from(Cyy)] += (m - 1) * c[idx]
+        Aa[rows] += np.dot(Cxy, linalg.solve(Cyy, D[idx] - Y, assume_a='pos'))
+
+    if not np.isreal(Aa).all():
+        Aa = Af
+        logger.warning('Aa not real')
     return Aa
 
 
@@ -463,7 +948,7 @@ def rBA_EnKF_CMAME(Af, d, Cdd, Cbb, k, M, b, J):
             Cdd: observation error covariance matrix [Nq x Nq]
             Cbb: bias covariance matrix [Nq x Nq]
             k: bias penalisation factor
-            M: matrix mapping from state to observation space [Nq x N]
+            M: operator mapping from state to observation space [Nq x N]
             b: bias of the forecast observables (Y = MAf + B) [Nq x 1]
             J: derivative of the bias with respect to the input [Nq x Nq]
         Returns:
@@ -475,11 +960,14 @@ def rBA_EnKF_CMAME(Af, d, Cdd, Cbb, k, M, b, J):
     Iq = np.eye(Nq)
     # Mean and deviations of the ensemble
     Psi_f = Af - np.mean(Af, 1, keepdims=True)
-    S = np.dot(M, Psi_f)
-    Q = np.dot(M, Af)
+    S = M @ Psi_f
+    Q = M @ Af
 
     # Create an ensemble of observations
-    D = rng.multivariate_normal(d, Cdd, Nm).transpose()
+    if d.ndim == 2 and d.shape[-1] == Nm:
+        D = d
+    else:
+        D = rng.multivariate_normal(d, Cdd, Nm).transpose()
 
     if b.ndim > 1 and b.shape[-1] == Nm:
         B = b
@@ -491,21 +979,24 @@ def rBA_EnKF_CMAME(Af, d, Cdd, Cbb, k, M, b, J):
 
     Y = Q + B
 
-    Cqq = np.dot(S, S.T)  # covariance of observations M Psi_f Psi_f.T M.T
     if np.array_equiv(Cdd, Cbb):
         CdWb = Iq
     else:
-        CdWb = np.dot(Cdd, linalg.inv(Cbb))
+        CdWb = linalg.solve(Cbb, Cdd.T, assume_a='pos').T  # Cdd Cbb^-1
 
-    Cinv = ((Nm - 1) * Cdd + np.dot(Iq + J, np.dot(Cqq, (Iq + J).T)) +
-            k * np.dot(CdWb, np.dot(J, np.dot(Cqq, J.T))))
+    # Cinv = (Nm - 1) Cdd + (I + J) Cqq (I + J)^T + k CdWb J Cqq J^T, with Cqq = S S^T, written as R + U V^T
+    IJS, JS = np.dot(Iq + J, S), np.dot(J, S)
+    U = np.hstack([IJS, k * np.dot(CdWb, JS)])
+    V = np.hstack([IJS, JS])
 
-    K = np.dot(Psi_f, np.dot(S.T, linalg.inv(Cinv)))
-    Aa = Af + np.dot(K, np.dot(Iq + J, D - Y) - k * np.dot(CdWb, np.dot(J, B)))
+    # K = Psi_f S^T Cinv^-1
+    X = ensemble_weights(S, (Nm - 1) * Cdd, np.dot(Iq + J, D - Y) - k * np.dot(CdWb, np.dot(J, B)),
+                         U=U, V=V, assume_pos=CdWb is Iq)
+    Aa = Af + np.dot(Psi_f, X)
 
 
     if not np.isreal(Aa).all():
-        print('Aa not real')
+        logger.warning('Aa not real')
         Aa = Af
 
     return Aa
@@ -519,7 +1010,7 @@ def rBA_EnKF(Af, d, Cdd, Cbb, k, M, b, J):
             Cdd: observation error covariance matrix [Nq x Nq]
             Cbb: bias covariance matrix [Nq x Nq]
             k: bias penalisation factor
-            M: matrix mapping from state to observation space [Nq x N]
+            M: operator mapping from state to observation space [Nq x N]
             b: bias of the forecast observables (Y = MAf + B) [Nq x 1]
             J: derivative of the bias with respect to the input [Nq x Nq]
         Returns:
@@ -532,11 +1023,14 @@ def rBA_EnKF(Af, d, Cdd, Cbb, k, M, b, J):
     Iq = np.eye(Nq)
     # Mean and deviations of the ensemble
     Psi_f = Af - np.mean(Af, 1, keepdims=True)
-    S = np.dot(M, Psi_f)
-    Q = np.dot(M, Af)
+    S = M @ Psi_f
+    Q = M @ Af
 
     # Create an ensemble of observations
-    D = rng.multivariate_normal(d, Cdd, Nm).transpose()
+    if d.ndim == 2 and d.shape[-1] == Nm:
+        D = d
+    else:
+        D = rng.multivariate_normal(d, Cdd, Nm).transpose()
 
 
     if b.ndim > 1 and b.shape[-1] == Nm:
@@ -551,25 +1045,365 @@ def rBA_EnKF(Af, d, Cdd, Cbb, k, M, b, J):
 
     Y = Q + B
 
-    Cqq = np.dot(S, S.T)  # covariance of observations M Psi_f Psi_f.T M.T
     if np.array_equiv(Cdd, Cbb):
         CdWb = Iq
     else:
-        CdWb = np.dot(Cdd, linalg.inv(Cbb))
+        CdWb = linalg.solve(Cbb, Cdd.T, assume_a='pos').T  # Cdd Cbb^-1
 
-    Cinv = (Nm - 1) * Cdd + np.dot(np.dot(Iq + J.T, Iq + J), Cqq) + k * np.dot(CdWb, np.dot(np.dot(J.T, J), Cqq))
+    # Cinv = (Nm - 1) Cdd + W Cqq, with Cqq = S S^T and W = (I + J^T)(I + J) + k CdWb J^T J
+    W = np.dot(Iq + J.T, Iq + J) + k * np.dot(CdWb, np.dot(J.T, J))
 
-    K = np.dot(Psi_f, np.dot(S.T, linalg.inv(Cinv)))
-    Aa = Af + np.dot(K, np.dot(Iq + J.T, D - Y) - k * np.dot(CdWb, np.dot(J.T, B)))
+    # K = Psi_f S^T Cinv^-1
+    X = ensemble_weights(S, (Nm - 1) * Cdd, np.dot(Iq + J.T, D - Y) - k * np.dot(CdWb, np.dot(J.T, B)),
+                         U=np.dot(W, S))
+    Aa = Af + np.dot(Psi_f, X)
 
     # Compute cost function terms (this could be commented out to increase speed)
     if np.isreal(Aa).all():
         return Aa
     else:
-        print('Aa not real')
+        logger.warning('Aa not real')
         return Af
 
 
+def rBA_EnSRKF(Af, d, Cdd, Cbb, k, M, b, J):
+    """ Bias-aware Ensemble Square-Root Kalman Filter. It minimises the same regularised cost as rBA_EnKF
+        without perturbed observations. With the bias linearised about the forecast, the cost is that of
+        the observations d - b + J y of (I + J) y, with covariance Cdd, and -b + J y of J y, with covariance
+        Cbb / k. The analysis is the EnSRKF (ensemble transform) of this augmented system, i.e.,
+        R_eff^-1 = (I + J)^T Cdd^-1 (I + J) + k J^T Cbb^-1 J.
+        Inputs:
+            Af: forecast ensemble at time t (augmented with Y) [N x Nm]
+            d: observation at time t [Nq x 1]
+            Cdd: observation error covariance matrix [Nq x Nq]
+            Cbb: bias covariance matrix [Nq x Nq]
+            k: bias penalisation factor
+            M: operator mapping from state to observation space [Nq x N]
+            b: bias of the forecast observables (Y = MAf + B) [Nq x 1]
+            J: derivative of the bias with respect to the input [Nq x Nq]
+        Returns:
+            Aa: analysis ensemble (or Af is Aa is not real)
+    """
+    Nq = len(d)
+    if b.ndim > 1:
+        b = np.mean(b, axis=-1)
+    y = M @ np.mean(Af, 1)
+
+    IJ = np.eye(Nq) + J
+    M_eff, d_eff, C_eff = IJ @ M, d - b + np.dot(J, y), Cdd
+    if k > 0:
+        M_eff = stack_operators([M_eff, J @ M])
+        d_eff = np.concatenate([d_eff, np.dot(J, y) - b])
+        C_eff = linalg.block_diag(Cdd, Cbb / k)
+
+    Aa = EnSRKF(Af, d_eff, C_eff, M_eff)
+
+    if np.isreal(Aa).all():
+        return Aa
+    else:
+        logger.warning('Aa not real')
+        return Af
+
+
+def rBA_EnKF_batch(Af, D, Cdd, Cbb, k, M, B, J):
+    """ rBA_EnKF for a batch of C ensembles, solved with stacked (3-D) linear algebra. With k = 0 and J = 0
+        (and B = 0) it is the EnKF.
+        Inputs:
+            Af: forecast ensembles (augmented with Y) [C x N x Nm]
+            D: ensembles of perturbed observations [C x Nq x Nm]
+            Cdd: observation error covariance matrix [Nq x Nq]
+            Cbb: bias covariance matrix [Nq x Nq]
+            k: bias penalisation factors [C]
+            M: operator mapping from state to observation space [Nq x N]
+            B: bias of the forecast observables [C x Nq x 1 or Nm]
+            J: derivatives of the bias with respect to the input [C x Nq x Nq]
+        Returns:
+            Aa: analysis ensembles [C x N x Nm]
+    """
+    Nm = Af.shape[-1]
+    Iq = np.eye(len(Cdd))
+
+    Psi_f = Af - np.mean(Af, -1, keepdims=True)
+    S = M @ Psi_f
+    Y = M @ Af + B
+
+    if np.array_equiv(Cdd, Cbb):
+        CdWb = Iq
+    else:
+        CdWb = linalg.solve(Cbb, Cdd.T, assume_a='pos').T  # Cdd Cbb^-1
+
+    # Cinv = (Nm - 1) Cdd + W Cqq, with Cqq = S S^T and W = (I + J^T)(I + J) + k CdWb J^T J
+    k = np.reshape(k, (-1, 1, 1))
+    Jt = np.swapaxes(J, -1, -2)
+    W = np.matmul(Iq + Jt, Iq + J) + k * np.matmul(CdWb, np.matmul(Jt, J))
+    Cinv = (Nm - 1) * Cdd + np.matmul(W, np.matmul(S, np.swapaxes(S, -1, -2)))
+    v = np.matmul(Iq + Jt, D - Y) - k * np.matmul(CdWb, np.matmul(Jt, B))
+
+    X = np.matmul(np.swapaxes(S, -1, -2), np.linalg.solve(Cinv, v))
+    return Af + np.matmul(Psi_f, X)
+
+
+def ensemble_weights(S, R, v, U=None, V=None, assume_pos=False):
+    """ Weights X = S^T (R + U V^T)^-1 v of the analysis increment Psi_f X, with U = V = S by default.
+        The system is solved in observation space with a Cholesky factorisation if it is symmetric
+        positive-definite. If there are more observations than columns in U, it is solved in ensemble
+        space with the Woodbury identity instead.
+        Inputs:
+            S: mapped forecast deviations [Nq x m]
+            R: observation error covariance, symmetric positive-definite [Nq x Nq]
+            v: innovations [Nq x ...]
+            U, V: low-rank update of R [Nq x p]
+            assume_pos: whether R + U V^T is symmetric positive-definite when U, V are given
+        Returns:
+            X: weights [m x ...]
+    """
+    if U is None:
+        U = V = S
+        assume_pos = True
+    elif V is None:
+        V = S
+    Nq, p = U.shape
+
+    if Nq <= p:
+        C = R + np.dot(U, V.T)
+        return np.dot(S.T, linalg.solve(C, v, assume_a='pos' if assume_pos else 'gen'))
+
+    # (R + U V^T)^-1 = R^-1 - R^-1 U (I + V^T R^-1 U)^-1 V^T R^-1
+    Rinv_v, Rinv_U = cov_solve(R, v), cov_solve(R, U)
+    G = np.eye(p) + np.dot(V.T, Rinv_U)
+    correction = linalg.solve(G, np.dot(V.T, Rinv_v), assume_a='pos' if U is V else 'gen')
+    return np.dot(S.T, Rinv_v - np.dot(Rinv_U, correction))
+
+
+def cov_solve(C, B):
+    """ Solve C X = B for a symmetric positive-definite matrix C, which is often diagonal. """
+    if np.count_nonzero(C - np.diag(np.diagonal(C))) == 0:
+        c = np.diagonal(C)
+        return B / (c if B.ndim == 1 else c[:, np.newaxis])
+    return linalg.cho_solve(linalg.cho_factor(C, lower=True), B)
+
+
+def cov_whiten(C, B):
+    """ Solve L X = B for the lower Cholesky factor L of a symmetric positive-definite matrix C = L L^T. """
+    if np.count_nonzero(C - np.diag(np.diagonal(C))) == 0:
+        c = np.sqrt(np.diagonal(C))
+        return B / (c if B.ndim == 1 else c[:, np.newaxis])
+    return linalg.solve_triangular(linalg.cholesky(C, lower=True), B, lower=True)
+
+
+class ObservationPerturbations:
+    """ Stream of perturbed observation ensembles D = d + L E, where L is the lower Cholesky factor of the
+        observation error covariance Cdd, computed once, and E are standard normal samples drawn from a
+        dedicated generator in blocks covering all the remaining analysis steps (or block_size steps if the
+        number of analyses is unknown).
+    """
+
+    def __init__(self, Cdd, m, N_analyses=None, seed=None, block_size=1000):
+        if np.count_nonzero(Cdd - np.diag(np.diagonal(Cdd))) == 0:
+            self.L = np.diag(np.sqrt(np.diagonal(Cdd)))
+        else:
+            self.L = linalg.cholesky(Cdd, lower=True)
+        self.m = m
+        self.remaining = N_analyses
+        self.block_size = block_size
+        self.rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])
+        self.block = np.empty((0, len(Cdd), m))
+        self.block_state = self.rng.bit_generator.state
+        self.i = 0
+
+    def draw(self, d):
+        if self.i == len(self.block):
+            # Pre-draw the perturbations for all the remaining analyses at once, if known
+            N = self.remaining if self.remaining is not None and self.remaining > 0 else self.block_size
+            self.block_state = self.rng.bit_generator.state
+            E = self.rng.standard_normal((N, len(self.L), self.m))
+            self.block = np.matmul(self.L, E)
+            self.i = 0
+        # If d is shorter, the leading rows of L E are the perturbations with the leading block of Cdd
+        D = np.expand_dims(d, axis=1) + self.block[self.i, :len(d)]
+        self.i += 1
+        if self.remaining is not None:
+            self.remaining -= 1
+        return D
+
+    def resize(self, m):
+        """ Draw the next perturbations for a new ensemble size """
+        self.m = m
+        self.block = np.empty((0, len(self.L), m))
+        self.block_state = self.rng.bit_generator.state
+        self.i = 0
+
+    def get_state(self):
+        """ Generator state at the start of the current block and position in it """
+        return dict(rng=self.block_state, N=len(self.block), i=self.i, remaining=self.remaining)
+
+    def set_state(self, state):
+        self.rng.bit_generator.state = state['rng']
+        self.block_state = state['rng']
+        self.block = np.matmul(self.L, self.rng.standard_normal((state['N'], len(self.L), self.m)))
+        self.i, self.remaining = state['i'], state['remaining']
+
+
+class EnsembleSizePolicy:
+    """ Adaptive ensemble size from the forecast statistics at each analysis. With S the mapped forecast
+        deviations, the spread ratio tr(S S^T) / (m-1) / tr(Cdd) measures the forecast spread relative to
+        the observation errors, and the innovation ratio |d - <y>|^2 / (tr(S S^T) / (m-1) + tr(Cdd)), which is
+        about one for a consistent filter, detects transients in which the ensemble is under-dispersed.
+        The ensemble grows by grow_factor when the innovation ratio exceeds grow_above, and it shrinks by
+        shrink_factor when the spread ratio stays below shrink_below and the innovations are consistent
+        for patience consecutive analyses.
+    """
+
+    def __init__(self, m_min, m_max, grow_factor=1.5, shrink_factor=0.75, grow_above=3., shrink_below=0.1,
+                 patience=5):
+        self.m_min = max(m_min, 2)
+        self.m_max = m_max
+        self.grow_factor = grow_factor
+        self.shrink_factor = shrink_factor
+        self.grow_above = grow_above
+        self.shrink_below = shrink_below
+        self.patience = patience
+        self.N_converged = 0
+
+    def new_size(self, case, d, Cdd):
+        """ Ensemble size to use after the analysis of the observation d """
+        m = case.m
+        innovation_ratio, spread_ratio = innovation_statistics(case, d, Cdd)
+
+        if innovation_ratio > self.grow_above:
+            self.N_converged = 0
+            return min(int(np.ceil(m * self.grow_factor)), self.m_max)
+        if spread_ratio < self.shrink_below and innovation_ratio < 1.:
+            self.N_converged += 1
+            if self.N_converged >= self.patience:
+                self.N_converged = 0
+                return max(int(m * self.shrink_factor), self.m_min)
+        else:
+            self.N_converged = 0
+        return m
+
+
+def innovation_statistics(case, d, Cdd):
+    """ Innovation ratio |d - <y>|^2 / (tr(S S^T) / (m-1) + tr(Cdd)) and spread ratio tr(S S^T) / (m-1) / tr(Cdd)
+        of the forecast observables y (with their bias) at the observation d, where S are their deviations
+    """
+    Y = case.get_observables() + case.bias.get_current_bias
+    y_mean = np.mean(Y, -1)
+    spread = np.sum((Y - y_mean[:, np.newaxis]) ** 2) / (case.m - 1)
+    return np.sum((d - y_mean) ** 2) / (spread + np.trace(Cdd)), spread / np.trace(Cdd)
+
+
+class AnalysisTrigger:
+    """ Adaptive triggering of the analyses from the innovation ratio |d - <y>|^2 / (tr(S S^T) / (m-1) + tr(Cdd)),
+        which is about one for a consistent filter. The analysis is skipped while the ratio is below threshold,
+        i.e. while the forecast already agrees with the observation well within its errors, and at most
+        max_skips analyses in a row are skipped. Skipped analyses lose the information of their observations,
+        so the threshold should be well below one, e.g. 0.1 skips about half the analyses of a converged
+        Lorenz63 run without loss of accuracy. In the asynchronous EnKF, the last observation of the window
+        is tested.
+    """
+
+    def __init__(self, threshold=0.1, max_skips=None):
+        self.threshold = threshold
+        self.max_skips = max_skips
+        self.N_skipped = 0
+
+    def analyse(self, case, d, Cdd):
+        """ Whether to perform the analysis of the observation d """
+        innovation_ratio = innovation_statistics(case, d, Cdd)[0]
+        if innovation_ratio >= self.threshold or (self.max_skips is not None and self.N_skipped >= self.max_skips):
+            self.N_skipped = 0
+            return True
+        self.N_skipped += 1
+        logger.debug('t = {:.3f}: analysis skipped, innovation ratio {:.2e}'.format(case.get_current_time,
+                                                                                    innovation_ratio))
+        return False
+
+
+class FixedLagSmoother:
+    """ Fixed-lag ensemble Kalman smoother. The ensemble states of the last lag assimilation windows (the
+        forecast between consecutive analyses, ending with the analysis) are kept in a ring buffer, and every
+        accepted analysis is applied to them retroactively. The filters give analyses of the form Aa = Af T,
+        with an m x m transform T, which is recovered from the augmented forecast and analysis by minimum-norm
+        least squares (exactly, since the increment weights are orthogonal to the ones vector; the localised
+        analyses, with a transform per group of rows, are not of this form and cannot be smoothed), and the
+        smoothed past states are A T. The transform is taken before inflation, and rejected analyses do not
+        update the past states. Windows leaving the buffer are final: their ensemble mean (and the ensemble
+        if keep_ensemble) is stored in t, mean (and ensemble) or, if on_release is given, passed to
+        on_release(t, A) instead. The memory is then bounded by the lag, e.g. in an OnlineAssimilator with
+        max_history.
+    """
+
+    def __init__(self, lag, keep_ensemble=False, on_release=None):
+        self.lag = lag
+        self.keep_ensemble = keep_ensemble
+        self.on_release = on_release
+        self.buffer = deque()
+        self.T = None
+        self.t, self.mean, self.ensemble = [], [], []
+
+    def set_analysis(self, Af, Aa):
+        """ Recover the transform of the analysis and smooth the buffered windows with it """
+        m = Af.shape[-1]
+        G = linalg.lstsq(np.vstack((Af, np.ones((1, m)))), np.vstack((Aa - Af, np.zeros((1, m)))))[0]
+        self.T = np.eye(m) + G
+        for _, A in self.buffer:
+            A[:] = np.matmul(A, self.T)
+
+    def push(self, case, Nt):
+        """ Add the window of the last Nt time steps of the case, ending with the analysis. The forecast
+            states before the analysis are smoothed by it.
+        """
+        Nt = max(Nt, 1)
+        t, A = case.hist_t[-Nt:].copy(), case.hist[-Nt:].copy()
+        if self.T is not None:
+            A[:-1] = np.matmul(A[:-1], self.T)
+        self.T = None
+        self.buffer.append((t, A))
+        while len(self.buffer) > self.lag:
+            self.release(*self.buffer.popleft())
+
+    def resize(self, W):
+        """ Apply the resizing weights W [m x m_new] of the ensemble to the buffered windows """
+        self.buffer = deque((t, np.matmul(A, W)) for t, A in self.buffer)
+
+    def release(self, t, A):
+        if self.on_release is not None:
+            self.on_release(t, A)
+            return
+        self.t.append(t)
+        self.mean.append(np.mean(A, axis=-1))
+        if self.keep_ensemble:
+            self.ensemble.append(A)
+
+    def flush(self):
+        """ Release all the buffered windows, e.g. at the end of the assimilation """
+        while self.buffer:
+            self.release(*self.buffer.popleft())
+
+    def get_mean(self):
+        """ Times and smoothed ensemble mean of the released windows [Nt], [Nt x N] """
+        if not self.t:
+            return np.empty(0), np.empty((0, 0))
+        return np.concatenate(self.t), np.concatenate(self.mean)
+
+
+def resize_weights(m, m_new, rng):
+    """ Weights W [m x m_new] of the linear combinations of the members that form the resized ensemble A W.
+        To grow, the current members are kept and the new ones are sampled from the ensemble distribution,
+        x_j = mean + Psi z_j / sqrt(m-1), with z_j standard normal. All the members are then shifted by the
+        same vector, so that the mean is unchanged without altering the deviations between them (re-centring
+        the new members among themselves would collapse a single new member onto the mean).
+        To shrink, a random subset of the members is kept.
+    """
+    if m_new <= m:
+        return np.eye(m)[:, np.sort(rng.choice(m, size=m_new, replace=False))]
+    Z = rng.standard_normal((m, m_new - m))
+    Z -= np.mean(Z, axis=0, keepdims=True)  # Deviations from the ensemble mean: (I - 1 1^T / m) Z
+    W = np.hstack((np.eye(m), 1. / m + Z / np.sqrt(m - 1)))
+    return W - np.sum(Z, axis=-1, keepdims=True) / (np.sqrt(m - 1) * m_new)
+
+
 # =================================================================================================================== #
 
 
@@ -585,6 +1419,11 @@ def print_DA_parameters(ensemble, t_obs):
           '\t Ensemble std(alpha0) = {}\n'.format(ensemble.std_a),
           '\t Number of analysis steps = {}, t0={}, t1={}'.format(len(t_obs), t_obs[0], t_obs[-1])
           )
-    if ensemble.filter == 'rBA_EnKF':
+    if 'rBA' in ensemble.filter:
         print('\t Bias penalisation factor k = {}\n'.format(ensemble.regularization_factor))
+    elif ensemble.filter == 'LETKF':
+        print('\t Localisation radius = {}\n'.format(ensemble.localisation_radius))
+    elif ensemble.filter == 'serial_EnKF':
+        print('\t Observation batch size = {}, localisation radius = {}\n'.format(ensemble.obs_batch_size,
+                                                                                ensemble.localisation_radius))
     print(' --------------------------------------------')
@@ -12,6 +12,7 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import scipy.io as sio
 
+from scipy.fft import next_fast_len
 from scipy.interpolate import interp1d
 from scipy.signal import find_peaks
 
@@ -163,6 +164,24 @@ def getEnvelope(timeseries_x, timeseries_y, fill_value=0):
     return u_p
 
 
+def gaspari_cohn(r, c):
+    """ Gaspari-Cohn (1999) fifth-order compactly supported correlation function. It is one at r = 0
+        and decays smoothly to zero at r = 2c.
+        Inputs:
+            r: distances (any shape)
+            c: localisation radius (half the support)
+        Returns:
+            rho: correlation weights, with the shape of r
+    """
+    z = np.abs(np.asarray(r, dtype=float)) / c
+    rho = np.zeros(z.shape)
+    inner, outer = z <= 1., (z > 1.) & (z < 2.)
+    zi, zo = z[inner], z[outer]
+    rho[inner] = -zi ** 5 / 4. + zi ** 4 / 2. + 5. * zi ** 3 / 8. - 5. * zi ** 2 / 3. + 1.
+    rho[outer] = zo ** 5 / 12. - zo ** 4 / 2. + 5. * zo ** 3 / 8. + 5. * zo ** 2 / 3. - 5. * zo + 4. - 2. / (3. * zo)
+    return np.maximum(rho, 0.)  # Round-off near r = 2c
+
+
 def save_to_pickle_file(filename, *args):
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     with open(filename, 'wb') as f:
@@ -301,6 +320,38 @@ def CR(y_true, y_est):
     return C, R
 
 
+def CR_lags(y_true, y_est, lags):
+    """ Root-mean square error of CR(y_true, y_est[lag:lag+Nt] / max(y_est[lag:lag+Nt])) for all the
+        lags and ensemble members at once, using FFT cross-correlations along time.
+        Inputs:
+            y_true: reference signal [Nt x Nq]
+            y_est: estimates to shift [N x Nq x L], with N >= max(lags) + Nt
+            lags: time shifts to evaluate
+        Returns:
+            R: root-mean square error of each lag and member [N_lags x L]
+    """
+    if y_est.ndim == 2:
+        y_est = np.expand_dims(y_est, axis=-1)
+    lags = np.asarray(lags, dtype=int)
+    Nt = y_true.shape[0]
+    N = y_est.shape[0]
+
+    # Cross-correlation sum_t y_true[t] * y_est[t + lag], summed over the observables
+    n_fft = next_fast_len(N + Nt)
+    cross = np.fft.irfft(np.conj(np.fft.rfft(y_true, n_fft, axis=0))[..., np.newaxis] *
+                         np.fft.rfft(y_est, n_fft, axis=0), n_fft, axis=0)
+    cross = np.sum(cross[lags], axis=1)
+
+    # Sum of squares and maximum of each window
+    cum_sq = np.concatenate([np.zeros((1, y_est.shape[-1])), np.cumsum(np.sum(y_est ** 2, axis=1), axis=0)])
+    sum_sq = cum_sq[lags + Nt] - cum_sq[lags]
+    max_w = np.max(np.lib.stride_tricks.sliding_window_view(np.max(y_est, axis=1), Nt, axis=0), axis=-1)[lags]
+
+    sum_true = np.sum(y_true ** 2)
+    R2 = (sum_true - 2 * cross / max_w + sum_sq / max_w ** 2) / sum_true
+    return np.sqrt(np.maximum(R2, 0.))
+
+
 def get_error_metrics(results_folder):
     print('computing error metrics...')
     out = dict(Ls=[], ks=[])
@@ -351,7 +402,7 @@ def get_error_metrics(results_folder):
             print('\t k = ', out['ks'][jj], '({}, {})'.format(filter_ens.bias.L, filter_ens.regularization_factor))
             # Compute biased and unbiased signals
             y, t = filter_ens.get_observable_hist(), filter_ens.hist_t
-            b, t_b = filter_ens.bias.hist, filter_ens.bias.hist_t
+            b, t_b = np.mean(filter_ens.bias.get_bias(state=filter_ens.bias.hist), -1), filter_ens.bias.hist_t
             y_mean = np.mean(y, -1)
 
             # Unbiased signal error
@@ -372,7 +423,7 @@ def get_error_metrics(results_folder):
             if ii == 0 and jj == 0:
                 i0_t = np.argmin(abs(truth['t'] - truth['t_obs'][0]))  # start of assimilation
                 i1_t = np.argmin(abs(truth['t'] - truth['t_obs'][-1]))  # end of assimilation
-                y_truth, t_truth = truth['y'][i0_t - N_CR:i1_t + N_CR], truth['t'][i0_t - N_CR:i1_t + N_CR]
+                y_truth, t_truth = truth['y_true'][i0_t - N_CR:i1_t + N_CR], truth['t'][i0_t - N_CR:i1_t + N_CR]
                 y_truth_b = y_truth - truth['b'][i0_t - N_CR:i1_t + N_CR]
 
                 out['C_true'], out['R_true'] = CR(y_truth[-N_CR:], y_truth_b[-N_CR:])
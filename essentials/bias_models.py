@@ -66,6 +66,10 @@ class Bias:
     def get_ML_state(self, **kwargs):
         return None
 
+    def depends_on_forecast(self, **kwargs):
+        """ Whether time_integrate requires the physical forecast y """
+        return False
+
     def print_bias_parameters(self):
         print('\n ---------------- {} bias model parameters --------------- '.format(self.name))
         for key in sorted(set(self.keys_to_print)):
@@ -103,6 +107,11 @@ class Bias:
     def update_current_state(self, b, **kwargs):
         self.hist[-1] = b
 
+    def resize_ensemble(self, W):
+        # A single (e.g. mean) bias estimate is shared by all the members
+        if self.N_ens == W.shape[0]:
+            self.hist = np.matmul(self.hist, W)
+
     def reset_history(self, b, t):
         self.hist_t = t
         self.hist = b
@@ -170,12 +179,22 @@ class ESN(Bias, EchoStateNetwork):
             kwargs['u'] = b
         self.reset_state(**kwargs)
 
+    def resize_ensemble(self, W):
+        if self.N_ens == W.shape[0]:
+            self.hist = np.matmul(self.hist, W)
+            u, r = self.get_reservoir_state()
+            self.reset_state(u=np.dot(u, W), r=np.dot(r, W))
+
     def state_derivative(self):
         u, r = [np.mean(xx, axis=-1, keepdims=True) for xx in self.get_reservoir_state()]
         J = self.Jacobian(open_loop_J=True, state=(u, r))  # Compute ESN Jacobian
         db_din = J[np.array(self.bias_idx), np.array([self.bias_idx]).T]
         return -db_din
 
+    def depends_on_forecast(self, wash_t=None, **kwargs):
+        # Only the open-loop washout is driven by the physical forecast
+        return not self.initialised and wash_t is not None
+
     def time_integrate(self, t, y=None, wash_t=None, wash_obs=None):
         if not self.trained:
             raise NotImplementedError('ESN model not trained')
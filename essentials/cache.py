@@ -0,0 +1,154 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+def default_cache_folder():
+    return os.path.join(os.getcwd(), 'data', 'cache', '')
+
+
+def make_hash(*args, **kwargs):
+    """ Stable hash of (nested) parameters. Dicts are hashed independently of their key order,
+        numpy arrays by dtype, shape and content, and classes/functions by their qualified name.
+    """
+    h = hashlib.sha1()
+    _update_hash(h, (args, kwargs))
+    return h.hexdigest()
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, dict):
+        h.update(b'dict%d' % len(obj))
+        for key in sorted(obj.keys(), key=str):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'list%d' % len(obj))
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, (np.ndarray, np.generic)):
+        obj = np.ascontiguousarray(obj)
+        h.update('array{}{}'.format(obj.dtype.str, obj.shape).encode())
+        h.update(obj.tobytes())
+    elif isinstance(obj, type) or callable(obj):
+        h.update('{}.{}'.format(getattr(obj, '__module__', ''),
+                                getattr(obj, '__qualname__', repr(obj))).encode())
+    else:
+        h.update(repr(obj).encode())
+
+
+def model_key(model, **extra):
+    """ Hash of everything that determines a model integration: model class, state,
+        parameters (of each member if the model is an ensemble), time step and seed.
+    """
+    if model.ensemble:
+        alpha = model.get_alpha()
+    else:
+        alpha = model.alpha0
+    return make_hash(type(model), model.get_current_state, alpha, model.governing_eqns_params,
+                     dt=model.dt, seed=model.seed, **extra)
+
+
+class ArrayCache:
+    """ Content-addressed store of numpy arrays on disk. Each entry is a single .npz file
+        named after its key. When the total size exceeds max_size (bytes), the least
+        recently used entries are removed.
+    """
+
+    def __init__(self, folder=None, max_size=2 ** 30):
+        if folder is None:
+            folder = default_cache_folder()
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def load(self, key):
+        filename = self.path(key)
+        try:
+            with np.load(filename) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        os.utime(filename)  # Mark as recently used
+        return arrays
+
+    def save(self, key, **arrays):
+        filename = self.path(key)
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_filename, filename)
+        self.evict()
+
+    def entries(self):
+        """ List of (path, size, last access) of the cached entries, most recently used first. """
+        out = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                filename = os.path.join(self.folder, name)
+                stat = os.stat(filename)
+                out.append((filename, stat.st_size, stat.st_mtime))
+        return sorted(out, key=lambda x: x[-1], reverse=True)
+
+    def evict(self):
+        total = 0
+        for filename, size, _ in self.entries():
+            total += size
+            if total > self.max_size:
+                os.remove(filename)
+
+    def clear(self):
+        for filename, _, _ in self.entries():
+            os.remove(filename)
+
+
+class DatasetStore:
+    """ Store of datasets (dicts) keyed by a hash of their generation parameters. Each dataset is a
+        folder with one .npy file per array, which are memory-mapped on load, and the remaining
+        entries in a small json metadata record.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.folder, key)
+
+    def load(self, key, mmap_mode='r'):
+        folder = self.path(key)
+        try:
+            with open(os.path.join(folder, 'metadata.json'), 'r') as f:
+                metadata = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        dataset = metadata['values']
+        for name in metadata['arrays']:
+            dataset[name] = np.load(os.path.join(folder, name + '.npy'), mmap_mode=mmap_mode)
+        return dataset
+
+    def save(self, key, dataset):
+        folder = self.path(key)
+        tmp_folder = folder + '.tmp'
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.makedirs(tmp_folder)
+
+        metadata = dict(arrays=[], values=dict())
+        for name, val in dataset.items():
+            if isinstance(val, np.ndarray):
+                np.save(os.path.join(tmp_folder, name + '.npy'), val)
+                metadata['arrays'].append(name)
+            elif isinstance(val, np.generic):
+                metadata['values'][name] = val.item()
+            else:
+                metadata['values'][name] = val
+        with open(os.path.join(tmp_folder, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, indent=1)
+
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(tmp_folder, folder)
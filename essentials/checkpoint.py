@@ -0,0 +1,91 @@
+import os
+import glob
+import json
+import numpy as np
+
+
+def checkpoint_files(folder):
+    """ Checkpoint files in the folder, in the order they were written """
+    return sorted(glob.glob(os.path.join(folder, 'checkpoint_*.npz')))
+
+
+def save_checkpoint(ensemble, folder, ti, rngs=None, **values):
+    """ Save a compact checkpoint of an assimilation run, to be resumed with load_checkpoint. It contains the
+        history of the ensemble and its bias since the previous checkpoint, the bias model state (e.g. the ESN
+        u and r), the state of the random generators in rngs and the json-serialisable values, such as
+        the loop index ti and counters.
+    """
+    os.makedirs(folder, exist_ok=True)
+    arrays = dict()
+
+    # History segments since the previous checkpoint (its last state is already final)
+    t_last = getattr(ensemble, 'checkpoint_t', None)
+    for key, model in zip(['', 'bias_'], [ensemble, ensemble.bias]):
+        if model is None:
+            continue
+        i0 = 0 if t_last is None else np.searchsorted(model.hist_t, t_last, side='right')
+        arrays[key + 'hist'] = model.hist[i0:]
+        arrays[key + 'hist_t'] = model.hist_t[i0:]
+
+    # Bias model state
+    bias = ensemble.bias
+    if bias is not None and hasattr(bias, 'get_reservoir_state'):
+        arrays['bias_u'], arrays['bias_r'] = bias.get_reservoir_state()
+        values['bias_initialised'] = bias.initialised
+
+    values['ti'] = ti
+    values['physical'] = getattr(ensemble, '_physical', 0)
+    values['rngs'] = {name: gen.bit_generator.state for name, gen in (rngs or {}).items()}
+    arrays['values'] = np.array(json.dumps(values))
+
+    filename = os.path.join(folder, 'checkpoint_{:06d}.npz'.format(ti))
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(filename + '.tmp', filename)
+    ensemble.checkpoint_t = ensemble.get_current_time
+    return filename
+
+
+def load_checkpoint(ensemble, folder, rngs=None, load_history=False):
+    """ Restore the ensemble (and bias) from the latest checkpoint in the folder. The ensemble must have been
+        created with the same settings as the checkpointed one, e.g. the same trained bias model. Only the
+        current state is restored unless load_history, in which case the history is rebuilt from the
+        segments of all the checkpoints.
+        Returns:
+            values: dictionary with the loop index ti and the other values saved with the checkpoint
+    """
+    files = checkpoint_files(folder)
+    if not files:
+        raise FileNotFoundError('No checkpoint found in ' + folder)
+
+    with np.load(files[-1]) as data:
+        values = json.loads(str(data['values']))
+        arrays = {name: data[name] for name in data.files if name != 'values'}
+
+    for key, model in zip(['', 'bias_'], [ensemble, ensemble.bias]):
+        if model is None:
+            continue
+        if load_history:
+            hist, hist_t = [], []
+            for filename in files:
+                with np.load(filename) as data:
+                    hist.append(data[key + 'hist'])
+                    hist_t.append(data[key + 'hist_t'])
+            if len(set(h.shape[-1] for h in hist)) > 1:
+                raise ValueError('The ensemble was resized, the history cannot be rebuilt')
+            model.hist, model.hist_t = np.concatenate(hist), np.concatenate(hist_t)
+        else:
+            model.hist, model.hist_t = arrays[key + 'hist'][-1:], arrays[key + 'hist_t'][-1:]
+
+    ensemble.m = ensemble.hist.shape[-1]  # The ensemble may have been resized
+    if 'bias_u' in arrays:
+        ensemble.bias.reset_state(u=arrays['bias_u'], r=arrays['bias_r'])
+        ensemble.bias.initialised = values['bias_initialised']
+
+    ensemble._physical = values['physical']
+    for name, gen in (rngs or {}).items():
+        if name in values['rngs']:
+            gen.bit_generator.state = values['rngs'][name]
+
+    ensemble.checkpoint_t = ensemble.get_current_time
+    return values
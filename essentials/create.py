@@ -4,12 +4,14 @@ import numpy as np
 from numba.cuda import local
 from essentials.Util import *
 from essentials.bias_models import *
+from essentials.cache import ArrayCache, DatasetStore, make_hash, model_key
 
 
 rng = np.random.default_rng(0)
 
 
-def create_ensemble(model=None, forecast_params=None, dt=None, alpha0=None, **filter_params):
+def create_ensemble(model=None, forecast_params=None, dt=None, alpha0=None,
+                    use_cache=True, cache_folder=None, **filter_params):
     if forecast_params is None:
         forecast_params = filter_params.copy()
     else:
@@ -31,8 +33,21 @@ def create_ensemble(model=None, forecast_params=None, dt=None, alpha0=None, **fi
         ensemble = model.copy()
 
     # Forecast model case to steady state initial condition before initialising ensemble
-    state, t_ = ensemble.time_integrate(int(ensemble.t_CR / ensemble.dt))
-    ensemble.update_history(state[-1], reset=True)
+    Nt = int(ensemble.t_CR / ensemble.dt)
+    cached = None
+    if use_cache:
+        cache = ArrayCache(folder=cache_folder)
+        key = model_key(ensemble, Nt=Nt, kind='post-transient')
+        cached = cache.load(key)
+
+    if cached is None:
+        state, t_ = ensemble.time_integrate(Nt)
+        psi = state[-1]
+        if use_cache:
+            cache.save(key, psi=psi)
+    else:
+        psi = cached['psi']
+    ensemble.update_history(psi, reset=True)
 
     # =========================  INITIALISE ENSEMBLE & BIAS  =========================== #
     ensemble.init_ensemble(**filter_params)
@@ -71,7 +86,11 @@ def create_ensemble(model=None, forecast_params=None, dt=None, alpha0=None, **fi
 
 
 def create_truth(model, t_start=None, t_stop=None, Nt_obs=20, std_obs=0.05, t_max=None, t_min=0.,
-                 noise_type='gauss, add', post_processed=False, manual_bias=None, **kwargs):
+                 noise_type='gauss, add', post_processed=False, manual_bias=None, N_avg=None, **kwargs):
+    """ Create the true signal and the observations every Nt_obs time steps between t_start and t_stop.
+        If N_avg is given, each observation is a super-observation of the N_avg raw samples around it (see
+        create_super_observations), and truth['Cdd'] is its error covariance, to be passed to dataAssimilation.
+    """
     # =========================== LOAD DATA OR CREATE TRUTH FROM LOM ================================ #
     if t_start is None:
         t_start = model.t_transient
@@ -127,18 +146,59 @@ def create_truth(model, t_start=None, t_stop=None, Nt_obs=20, std_obs=0.05, t_ma
 
     dt_t = t_true[1] - t_true[0]
     obs_idx = np.arange(t_start // dt_t, t_stop // dt_t + 1, Nt_obs, dtype=int)
+    if N_avg is None:
+        y_obs, t_obs, Cdd = y_raw[obs_idx], t_true[obs_idx], None
+    else:
+        y_obs, t_obs, Cdd = create_super_observations(t_true, y_raw, obs_idx, N_avg)
 
     # ================================ SAVE DATA TO DICT ==================================== #
     if '/' in name_truth:
         name_truth = '_'.join(name_truth.split('/'))
 
     truth = dict(y_raw=y_raw, y_true=y_true, t=t_true, b=b_true, dt=dt_t,
-                 t_obs=t_true[obs_idx], y_obs=y_raw[obs_idx], dt_obs=Nt_obs * dt_t,
+                 t_obs=t_obs, y_obs=y_obs, Cdd=Cdd, dt_obs=Nt_obs * dt_t,
                  name=name_truth, name_bias=name_bias, noise_type=noise_type,
                  model=model, std_obs=std_obs, true_params=kwargs, case=true_case)
     return truth
 
 
+def create_super_observations(t, y, obs_idx, N_avg):
+    """ Super-observations from windows of N_avg samples of the signal y centred at the observation indices
+        (shifted inwards at the ends of the record). Each super-observation is the value at the observation
+        time of a local linear fit to its window, which is the window average for centred windows. Its error
+        variance is that of the fit, s^2 (1/N_avg + x_m^2 / S_xx), with s^2 the variance of the residuals of
+        the fit and x_m, S_xx the mean and spread of the window times relative to the observation time.
+        The residuals include the signal curvature within the window, so the variance is conservative.
+        Inputs:
+            t: times of the signal [Nt]
+            y: signal [Nt x Nq]
+            obs_idx: indices of the observation times
+            N_avg: number of samples per super-observation (at least 3)
+        Returns:
+            y_obs: super-observations [N_obs x Nq]
+            t_obs: observation times [N_obs]
+            Cdd: diagonal observation error covariance, with the mean variance of each observable [Nq x Nq]
+    """
+    if N_avg < 3:
+        raise ValueError('At least 3 samples are needed per super-observation')
+    obs_idx = np.asarray(obs_idx, dtype=int)
+    i0 = np.clip(obs_idx - N_avg // 2, 0, len(t) - N_avg)
+    idx = i0[:, np.newaxis] + np.arange(N_avg)
+
+    x = t[idx] - t[obs_idx, np.newaxis]  # [N_obs x N_avg]
+    Y = y[idx]  # [N_obs x N_avg x Nq]
+    x_m = np.mean(x, axis=1, keepdims=True)
+    y_m = np.mean(Y, axis=1, keepdims=True)
+    S_xx = np.sum((x - x_m) ** 2, axis=1, keepdims=True)
+    slope = np.sum((x - x_m)[..., np.newaxis] * (Y - y_m), axis=1, keepdims=True) / S_xx[..., np.newaxis]
+
+    y_obs = (y_m - slope * x_m[..., np.newaxis])[:, 0]
+    residuals = Y - y_m - slope * (x - x_m)[..., np.newaxis]
+    s2 = np.sum(residuals ** 2, axis=1) / (N_avg - 2)
+    var_obs = s2 * (1. / N_avg + x_m ** 2 / S_xx)
+    return y_obs, t[obs_idx], np.diag(np.mean(var_obs, axis=0))
+
+
 def create_observations_from_file(name, t_max, t_min=0.):
     # Wave case: load .mat file ====================================
     try:
@@ -165,7 +225,7 @@ def create_observations_from_file(name, t_max, t_min=0.):
     return y_raw, y_true, t_true, name.split('data/')[-1]
 
 
-def create_observations(model, t_max, t_min, save=False, data_folder=None, **true_parameters):
+def create_observations(model, t_max, t_min, save=False, data_folder=None, use_cache=True, **true_parameters):
     try:
         TA_params = true_parameters.copy()
         model = model
@@ -193,8 +253,22 @@ def create_observations(model, t_max, t_min, save=False, data_folder=None, **tru
         print('Load true data: ' + name)
     else:
         case = model(**TA_params)
-        psi, t = case.time_integrate(int(t_max / case.dt))
-        case.update_history(psi, t)
+        Nt = int(t_max / case.dt)
+
+        # Reuse the integration of an identical configuration if available
+        cached = None
+        if use_cache:
+            cache = ArrayCache(folder=data_folder + 'cache/')
+            key = model_key(case, Nt=Nt, kind='truth')
+            cached = cache.load(key)
+
+        if cached is None:
+            psi, t = case.time_integrate(Nt)
+            case.update_history(psi, t)
+            if use_cache:
+                cache.save(key, hist=case.hist, hist_t=case.hist_t)
+        else:
+            case.reset_history(cached['hist'], cached['hist_t'])
         case.close()
         if save:
             save_to_pickle_file(name, case)
@@ -212,29 +286,29 @@ def create_observations(model, t_max, t_min, save=False, data_folder=None, **tru
     return y_true, t_true, name.split('Truth_')[-1], case
 
 
-def create_noisy_signal(y_clean, noise_level=0.1, noise_type='gauss, add'):
+def create_noisy_signal(y_clean, noise_level=0.1, noise_type='gauss, add', chunk_size=None):
+    """ Add Gaussian or coloured noise to a signal of shape (Nt x q) or (Nt x q x L).
+        All realisations and observables are generated at once. If chunk_size is given, at most
+        chunk_size time steps (gaussian noise) or the equivalent number of time series (coloured
+        noise) are generated at a time to bound the memory of very long signals.
+    """
     if y_clean.ndim == 2:
         y_clean = np.expand_dims(y_clean, -1)
 
     Nt, q, L = y_clean.shape
     y_noisy = y_clean.copy()
 
-    for ll in range(L):
-        if 'gauss' in noise_type.lower():
-            noise = rng.multivariate_normal(np.zeros(q), np.eye(q) * noise_level ** 2, Nt)
-        else:
-            i0 = Nt % 2 != 0  # Add extra step if odd
-            noise = np.zeros([Nt, q])
-            for ii in range(q):
-                noise_white = np.fft.rfft(rng.standard_normal(Nt + i0) * noise_level)
-                # Generate the noise signal
-                S = colour_noise(Nt + i0, noise_colour=noise_type)
-                S = noise_white * S / np.sqrt(np.mean(S ** 2))  # Normalize S
-                noise[:, ii] = np.fft.irfft(S)[i0:]  # transform back into time domain
-        if 'add' in noise_type.lower():
-            y_noisy[:, :, ll] += noise * np.max(abs(y_clean[:, :, ll]))
+    if 'add' in noise_type.lower():
+        scale = np.max(abs(y_clean), axis=(0, 1))  # L
+    else:
+        scale = None
+
+    for i0, i1, noise in noise_blocks(Nt, q, L, noise_level=noise_level, noise_type=noise_type,
+                                      chunk_size=chunk_size):
+        if scale is not None:
+            y_noisy[i0:i1] += noise * scale
         else:
-            y_noisy[:, :, ll] += noise * y_noisy[:, :, ll]
+            y_noisy[i0:i1] += noise * y_noisy[i0:i1]
 
     y_noisy = y_noisy.squeeze()
 
@@ -244,6 +318,33 @@ def create_noisy_signal(y_clean, noise_level=0.1, noise_type='gauss, add'):
     return y_noisy
 
 
+def noise_blocks(Nt, q, L, noise_level=0.1, noise_type='gauss', chunk_size=None):
+    """ Generator of noise of shape (Nt x q x L) in time blocks (i0, i1, noise[i0:i1]).
+        Coloured noise is shaped with a single rfft/irfft along the time axis, batched over
+        the (q x L) time series.
+    """
+    if chunk_size is None:
+        chunk_size = Nt
+
+    if 'gauss' in noise_type.lower():
+        for i0 in range(0, Nt, chunk_size):
+            i1 = min(i0 + chunk_size, Nt)
+            yield i0, i1, rng.standard_normal((i1 - i0, q, L)) * noise_level
+    else:
+        i0 = Nt % 2 != 0  # Add extra step if odd
+        S = colour_noise(Nt + i0, noise_colour=noise_type)
+        S = S / np.sqrt(np.mean(S ** 2))  # Normalize S
+        S = S[:, np.newaxis]
+
+        noise = np.empty((Nt, q * L))
+        N_series = max(1, min(q * L, (chunk_size * q * L) // Nt))
+        for j0 in range(0, q * L, N_series):
+            j1 = min(j0 + N_series, q * L)
+            noise_white = np.fft.rfft(rng.standard_normal((Nt + i0, j1 - j0)) * noise_level, axis=0)
+            noise[:, j0:j1] = np.fft.irfft(noise_white * S, n=Nt + i0, axis=0)[i0:]  # back to time domain
+        yield 0, Nt, noise.reshape((Nt, q, L))
+
+
 def create_bias_model(ensemble, bias_params: dict,
                       training_dataset: dict or list,
                       wash_t=None,
@@ -335,6 +436,53 @@ def create_washout(bias_case, t_true, y_raw):
     return wash_t, wash_obs
 
 
+def spin_up_ensemble(ensemble, Nt, N_window, tol=1e-1, max_FP_ratio=0.2, rtol_amplitude=None, N_converged=2):
+    """ Forecast the ensemble over its transient in windows of N_window steps, storing only the last state.
+        After each window, the members whose observables oscillate with an amplitude smaller than tol
+        (i.e., fixed points) are replaced by samples of the other members, keeping at most a ratio max_FP_ratio
+        of fixed points. If rtol_amplitude is given, the transient is stopped early once the amplitude of
+        every member changes less than rtol_amplitude between N_converged consecutive windows.
+        Returns:
+            Number of time steps forecast
+    """
+    N_allowed = int(max_FP_ratio * ensemble.m) + 1
+    amplitude_old, converged, Nt_done = None, 0, 0
+
+    while Nt_done < Nt:
+        N_i = min(N_window, Nt - Nt_done)
+        psi, t = ensemble.time_integrate(Nt=N_i)
+        ensemble.update_history(psi, t)
+        y = ensemble.get_observable_hist(N_i)
+        ensemble.update_history(psi=psi[-1], t=t[-1:], reset=True)
+        Nt_done += N_i
+
+        # -------------  Remove and replace fixed points ------------- #
+        amplitude = np.max(np.max(y, axis=0) - np.min(y, axis=0), axis=0)
+        idx_FP = amplitude < tol
+        if N_i == N_window and N_allowed < np.sum(idx_FP) < len(idx_FP) - 1:
+            idx_FP[np.flatnonzero(idx_FP)[:N_allowed]] = False
+            print('Replace {}/{} fixed points at t = {:.3f}'.format(np.sum(idx_FP), len(idx_FP), t[-1]))
+            psi0 = ensemble.get_current_state.copy()
+            psi0[:, idx_FP] = rng.multivariate_normal(np.mean(psi0[:, ~idx_FP], axis=-1),
+                                                      np.cov(psi0[:, ~idx_FP]), np.sum(idx_FP)).T
+            ensemble.update_history(psi=psi0, t=t[-1:], reset=True)
+            amplitude_old, converged = None, 0
+            continue
+
+        # -------------  Stop if the amplitude of the oscillations has converged ------------- #
+        if rtol_amplitude is not None and amplitude_old is not None:
+            if np.all(abs(amplitude - amplitude_old) <= rtol_amplitude * amplitude_old):
+                converged += 1
+                if converged >= N_converged:
+                    print('Transient converged after {}/{} steps'.format(Nt_done, Nt))
+                    break
+            else:
+                converged = 0
+        amplitude_old = amplitude
+
+    return Nt_done
+
+
 def create_bias_training_dataset(y_raw: list, y_pp: list, ensemble,
                                  t_train=None,
                                  t_val=None,
@@ -350,6 +498,8 @@ def create_bias_training_dataset(y_raw: list, y_pp: list, ensemble,
                                  filename=None,
                                  len_augment_set=2,
                                  plot_train_dataset=True,
+                                 fixed_point_tol=1e-1,
+                                 spin_up_rtol=5e-3,
                                  **train_params):
 
     """
@@ -412,24 +562,22 @@ def create_bias_training_dataset(y_raw: list, y_pp: list, ensemble,
 
     # =========================== Load training data if available ============================== #
     if filename is not None:
-        try:
-            loaded_train_data = load_from_pickle_file(filename)
-            try:
-                if check_valid_file(loaded_train_data, dict(**requested_dict, **train_params)):
-                    _U = loaded_train_data['data']
-                    if _U.shape[1] < Nt_min:
-                        print('Re-run multi-parameter training data: Increase the length of the training data')
-                    elif augment_data and _U.shape[0] == L:
-                        print('Re-run multi-parameter training data: need data augment ')
-                    else:
-                        print('Loaded multi-parameter training data')
-                        if plot_train_dataset:
-                            plot_dataset(plot_data=loaded_train_data['data'])
-                        return loaded_train_data
-            except TypeError:
-                print(f'File {filename} type = {type(loaded_train_data)} is not dict')
-        except FileNotFoundError:
-            print(f'Run multi-parameter training data: file {filename} not found')
+        # The dataset is identified by all the parameters of its generation
+        generation_params = dict(requested_dict, t_test=t_test, N_wash=N_wash, perform_test=perform_test,
+                                 correlation_based_training=correlation_based_training,
+                                 len_augment_set=len_augment_set, fixed_point_tol=fixed_point_tol,
+                                 spin_up_rtol=spin_up_rtol, train_params=train_params)
+        data_key = '{}_{}'.format(os.path.basename(filename),
+                                  make_hash(generation_params, y_raw, y_pp, model_key(train_ens)))
+        data_store = DatasetStore(os.path.dirname(filename) or os.getcwd())
+
+        loaded_train_data = data_store.load(data_key)
+        if loaded_train_data is not None:
+            print('Loaded multi-parameter training data')
+            if plot_train_dataset:
+                plot_dataset(plot_data=loaded_train_data['data'])
+            return loaded_train_data
+        print(f'Run multi-parameter training data: {data_key} not found')
     print('Rerun training data')
 
     # =================  Create ensemble for multi-parameter training data generation ============================ #
@@ -438,27 +586,10 @@ def create_bias_training_dataset(y_raw: list, y_pp: list, ensemble,
     train_params['m'] = L
     train_ens.init_ensemble(**train_params)
 
-    # Forecast ensemble
-    psi, t = train_ens.time_integrate(Nt=int(round(t_train / train_ens.dt)))
-    train_ens.update_history(psi, t)
-    y_L_model = train_ens.get_observable_hist()  # N_train x Nq x m
-
-    # -------------  Remove and replace fixed points ------------- #
-    tol = 1e-1
+    # Forecast the transient in windows, replacing the fixed points as soon as they are detected
     N_CR = int(round(train_ens.t_CR / train_ens.dt))
-    range_y = np.max(np.max(y_L_model[-N_CR:], axis=0) - np.min(y_L_model[-N_CR:], axis=0), axis=0)
-    idx_FP = (range_y < tol)
-    psi0 = psi[-1, :, ~idx_FP]  # Nq x (m - #FPs)
-    if len(np.flatnonzero(idx_FP)) / len(idx_FP) >= 0.2:
-        allowed_FPs = np.flatnonzero(idx_FP)[0:int(0.2 * len(idx_FP)) + 1]
-        idx_FP[allowed_FPs] = 0
-        psi0 = psi[-1, :, ~idx_FP]  # non-fixed point ICs (keeping one)
-        print('There are {}/{} fixed points'.format(len(np.flatnonzero(idx_FP)), len(idx_FP)))
-        new_psi0 = rng.multivariate_normal(np.mean(psi0, axis=0), np.cov(psi0.T), len(np.flatnonzero(idx_FP)))
-        psi0 = np.concatenate([psi0, new_psi0], axis=0)
-
-    # Reset ensemble with post-transient ICs
-    train_ens.update_history(psi=psi0.T, reset=True)
+    spin_up_ensemble(train_ens, Nt=int(round(t_train / train_ens.dt)), N_window=N_CR,
+                     tol=fixed_point_tol, rtol_amplitude=spin_up_rtol)
 
     # -------------  Forecast fixed-point-free ensemble ------------- #
     N_corr = N_CR
@@ -491,13 +622,14 @@ def create_bias_training_dataset(y_raw: list, y_pp: list, ensemble,
             _y_raw_corr = _y_raw[:N_corr, ..., 0]
             train_data_model = np.zeros([Nt_min, train_ens.Nq, L * len_augment_set])
 
-            for ii in range(train_ens.m):
-                yy = y_L_model[:, :, ii]
+            # RMS error of every lag and member at once (N_lags x m)
+            _RS = CR_lags(_y_raw_corr, y_L_model[:lags[-1] + N_corr], lags)
+            best_lags = lags[np.argmin(_RS, axis=0)]  # fully correlated
+            worst_lags = lags[np.argmax(_RS, axis=0)]  # fully uncorrelated
+            mid_lags = ((best_lags + worst_lags) // 2).astype(int)  # mid-correlated
 
-                _RS = [CR(_y_raw_corr, yy[lag:N_corr + lag] / np.max(yy[lag:N_corr + lag]))[1] for lag in lags]
-                best_lag = lags[np.argmin(_RS)]  # fully correlated
-                worst_lag = lags[np.argmax(_RS)]  # fully uncorrelated
-                mid_lag = int(np.mean([best_lag, worst_lag]))  # mid-correlated
+            for ii, best_lag, mid_lag, worst_lag in zip(range(train_ens.m), best_lags, mid_lags, worst_lags):
+                yy = y_L_model[:, :, ii]
                 # Store train data
                 train_data_model[:, :, len_augment_set * ii] = yy[best_lag:best_lag + Nt_min]
                 train_data_model[:, :, len_augment_set * ii + 1] = yy[mid_lag:mid_lag + Nt_min]
@@ -543,7 +675,7 @@ def create_bias_training_dataset(y_raw: list, y_pp: list, ensemble,
         train_data[k] = locals()[k]
 
     if filename is not None:
-        save_to_pickle_file(filename, train_data)
+        data_store.save(data_key, train_data)
 
     if plot_train_dataset:
         plot_dataset(plot_data=train_data['data'])
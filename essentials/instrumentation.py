@@ -0,0 +1,60 @@
+import json
+import time
+from collections import deque
+
+
+class Instrumentation:
+    """ Lightweight record of the wall time spent in each phase of the assimilation cycles and of event
+        counters. A cycle starts with an analysis and ends with the forecast to the next observation
+        (the first record is the forecast to the first observation). If max_cycles is given, only the records
+        of the last max_cycles cycles are kept, while the totals include all the cycles.
+    """
+
+    phases = ['forecast', 'bias_forecast', 'analysis', 'inflation', 'update']
+
+    def __init__(self, max_cycles=None):
+        self.cycles = deque(maxlen=max_cycles)
+        self.running_totals = dict()
+        self.counters = dict()
+        self.current = None
+        self.new_cycle()
+
+    def new_cycle(self, **info):
+        self.current = dict(info)
+        self.cycles.append(self.current)
+
+    def add_time(self, phase, dt):
+        self.current[phase] = self.current.get(phase, 0.) + dt
+        self.running_totals[phase] = self.running_totals.get(phase, 0.) + dt
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def totals(self):
+        """ Total wall time per phase over all the cycles """
+        return {phase: val for phase, val in self.running_totals.items() if phase in self.phases}
+
+    def to_dict(self):
+        return dict(totals=self.totals(), counters=self.counters, cycles=list(self.cycles))
+
+    def to_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, default=float)
+
+
+def record(case, phase, t0):
+    """ Add the wall time since t0 (from time.perf_counter) to a phase of the cycle if the case is instrumented
+        Returns:
+            the current time, to be used as t0 of the next phase
+    """
+    t1 = time.perf_counter()
+    instrumentation = getattr(case, 'instrumentation', None)
+    if instrumentation is not None:
+        instrumentation.add_time(phase, t1 - t0)
+    return t1
+
+
+def count(case, name, n=1):
+    instrumentation = getattr(case, 'instrumentation', None)
+    if instrumentation is not None:
+        instrumentation.count(name, n)
@@ -0,0 +1,327 @@
+import time
+import asyncio
+import logging
+import numpy as np
+from collections import deque
+
+from essentials.DA import forecastStep, analysisStep, updateStep, resizeStep, ObservationPerturbations, \
+    get_window_observables, set_smoother
+from essentials.instrumentation import Instrumentation, record, count
+
+logger = logging.getLogger(__name__)
+
+
+class OnlineAssimilator:
+    """ Stateful sequential data assimilation for observations that arrive one at a time. Each call to
+        assimilate forecasts the ensemble (and its bias) to the observation time, performs the analysis with
+        the same forecastStep/analysisStep as dataAssimilation, and returns the analysis immediately.
+        Hooks are called with the assimilator and the result of every cycle, and the timings of each cycle
+        (forecast to the observation and analysis) are recorded in ensemble.instrumentation. If max_history
+        is given, only the last max_history time steps of the ensemble and bias histories are kept, so that
+        the memory is bounded and the assimilator can run indefinitely (the timings of only the last
+        max_history cycles are kept too). A FixedLagSmoother updates the states of the last windows with each
+        analysis, with memory bounded by its lag.
+
+        The observation error covariance is fixed for the whole run. Either Cdd or the amplitude y_scale of
+        the observations must be given; in the latter case, Cdd is defined as in dataAssimilation.
+    """
+
+    def __init__(self, ensemble, std_obs=0.2, Cdd=None, y_scale=None, max_history=None, hooks=None,
+                 ensemble_size_policy=None, smoother=None, **kwargs):
+        self.ensemble = ensemble
+        self.std_obs = std_obs
+        self.y_scale = y_scale
+        self.Cdd = Cdd
+        self.define_Cdd()
+        self.max_history = max_history
+        self.ensemble_size_policy = ensemble_size_policy
+        set_smoother(self.ensemble, smoother)
+        self.hooks = list(hooks) if hooks is not None else []
+        self.forecast_kwargs = kwargs  # e.g. the washout of the bias model, used in the first forecast
+        self.ti = 0
+        self.N_forecasts = 0
+        self.max_window = 1  # Observations per analysis, to size the perturbations
+        self.ensemble.instrumentation = Instrumentation(max_cycles=max_history)
+        self.ensemble.activate_bias_aware, self.ensemble.activate_parameter_estimation = False, False
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def define_Cdd(self):
+        if self.Cdd is None:
+            if self.y_scale is None:
+                raise ValueError('OnlineAssimilator needs the observation error covariance Cdd or the amplitude '
+                                 'y_scale of the observations')
+            Nq = self.ensemble.Nq
+            self.Cdd = np.diag((self.std_obs * np.ones(Nq))) * np.asarray(self.y_scale, dtype=float) ** 2
+        if np.any(np.diag(self.Cdd) <= 0):
+            raise ValueError('The observation error variances in the diagonal of Cdd must be positive')
+
+    def assimilate(self, t, d):
+        """ Forecast the ensemble to time t and assimilate the observation d
+            Returns:
+                result: dictionary with the time, observation, analysis ensemble and mean analysis innovation
+        """
+        d = np.array(d, dtype=float)  # The bias-aware analysis modifies d
+        self.ensemble.instrumentation.new_cycle(t=float(t))
+        Nt = self.forecast(t)
+        return self.analyse(d, Nt)
+
+    def forecast(self, t, averaged=False):
+        """ Forecast the ensemble (or its mean, if averaged) to time t
+            Returns:
+                Nt: number of time steps forecast
+        """
+        case = self.ensemble
+        Nt = int(np.round((t - case.get_current_time) / case.dt))
+        if Nt < 0:
+            raise ValueError('Observation at t = {} before the current time {}'.format(t, case.get_current_time))
+        if Nt > 0:
+            # The first forecast (e.g. with the washout of the bias model) is the first with time steps
+            if self.N_forecasts == 0:
+                forecastStep(case, Nt, averaged=averaged, **self.forecast_kwargs)
+                if case.bias_bayesian_update and case.bias.N_ens != case.m:
+                    raise AssertionError('Wrong ESN initialisation')
+            else:
+                forecastStep(case, Nt, averaged=averaged)
+            self.N_forecasts += 1
+        return Nt
+
+    def analyse(self, d, Nt, t_window=None, d_window=None):
+        """ Assimilate the observation d at the current time, Nt time steps after the previous analysis. If
+            t_window is given, the earlier observations d_window at those times are assimilated together
+            with d in an asynchronous analysis.
+        """
+        case = self.ensemble
+        if getattr(case, 'perturbations', None) is None:
+            case.perturbations = ObservationPerturbations(np.kron(np.eye(self.max_window), self.Cdd), case.m,
+                                                          seed=int(case.rng.integers(2 ** 63)))
+
+        case.activate_bias_aware = self.ti >= case.num_DA_blind
+        case.activate_parameter_estimation = self.ti >= case.num_SE_only
+
+        if self.ensemble_size_policy is not None:
+            m_new = self.ensemble_size_policy.new_size(case, d, self.Cdd)
+        if t_window is None or len(t_window) == 0:
+            Aa = analysisStep(case, d, self.Cdd)
+        else:
+            Y_window = get_window_observables(case, np.asarray(t_window))
+            K = len(t_window) + 1
+            Aa = analysisStep(case, np.concatenate(list(d_window) + [d]), np.kron(np.eye(K), self.Cdd),
+                              Y_window=Y_window.reshape(-1, case.m))
+        t0 = time.perf_counter()
+        ia = updateStep(case, Aa, d, self.Cdd)
+        if case.smoother is not None:
+            case.smoother.push(case, Nt)
+        if self.ensemble_size_policy is not None:
+            resizeStep(case, m_new)
+
+        self.ti += 1
+        case.number_of_analysis_steps = self.ti
+        self.trim_history()
+        record(case, 'update', t0)
+
+        result = dict(t=case.get_current_time, d=d, Aa=Aa, ia=ia)
+        for hook in self.hooks:
+            hook(self, result)
+        return result
+
+    def run(self, observations):
+        """ Assimilate the (t, d) pairs of an iterable or generator, yielding the result of each cycle """
+        for t, d in observations:
+            yield self.assimilate(t, d)
+
+    async def run_async(self, observations):
+        """ Assimilate the (t, d) pairs of an async iterator. The cycles run in a worker thread so that
+            the event loop can keep receiving data.
+        """
+        loop = asyncio.get_running_loop()
+        async for t, d in observations:
+            yield await loop.run_in_executor(None, self.assimilate, t, d)
+
+    def trim_history(self):
+        if self.max_history is None:
+            return
+        for model in [self.ensemble, self.ensemble.bias]:
+            if model is not None and len(model.hist_t) > self.max_history:
+                # Copy so that the full arrays are released
+                model.hist = model.hist[-self.max_history:].copy()
+                model.hist_t = model.hist_t[-self.max_history:].copy()
+        if hasattr(self.ensemble, 'rejected_analysis'):
+            self.ensemble.rejected_analysis = self.ensemble.rejected_analysis[-self.max_history:]
+
+    def close(self):
+        if self.ensemble.smoother is not None:
+            self.ensemble.smoother.flush()
+        self.ensemble.perturbations, self.ensemble.smoother = None, None
+        self.ensemble.close()
+
+
+class SimulatedClock:
+    """ Clock to test the real-time operation without waiting. The time only advances with advance() and with
+        the simulated cost of the work done by the assimilator: forecast_cost per member and time step, and
+        analysis_cost per member and analysis.
+    """
+
+    def __init__(self, t0=0., forecast_cost=0., analysis_cost=0.):
+        self.now = t0
+        self.costs = dict(forecast=forecast_cost, analysis=analysis_cost)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, dt):
+        self.now += dt
+
+    def spend(self, phase, work):
+        self.now += work * self.costs[phase]
+
+
+class RealTimeAssimilator(OnlineAssimilator):
+    """ Online assimilation of sensor blocks that must be processed before the next block arrives. The cost of
+        the forecast (per member and time step) and of the analysis (per member) are measured with the clock
+        and, before each cycle, the cheapest of the following modes that fits in the time left is used:
+            full: forecast and analysis with the full ensemble of m_full members
+            reduced: forecast and analysis with the largest ensemble of at least m_min members that fits
+            merge: forecast only, and the observation is assimilated in the next analysis (asynchronous
+                   analysis of up to max_merge + 1 observations, not available for the bias-aware filters)
+            skip: forecast only, and the observation is discarded
+            averaged: forecast of the ensemble mean only, keeping the deviations, and no analysis
+        A mode fits if its predicted latency is less than safety times the time left. After a reduction, the
+        full ensemble is restored once its predicted latency is below recover_below times the time left.
+        The last max_decisions decisions, without their analysis results, are kept in decisions, and every
+        decision is logged (at debug level for full cycles).
+
+        The clock is a function returning the current time in seconds, e.g. a SimulatedClock. Each block
+        arrives at its arrival time (the time of the call if not given) and its deadline is budget seconds
+        later.
+    """
+
+    modes = ['full', 'reduced', 'merge', 'skip', 'averaged']
+
+    def __init__(self, ensemble, budget, clock=time.perf_counter, m_min=None, max_merge=2, safety=0.8,
+                 recover_below=0.5, smoothing=0.3, max_decisions=1000, **kwargs):
+        super().__init__(ensemble, **kwargs)
+        self.budget = budget
+        self.clock = clock
+        self.m_full = ensemble.m
+        self.m_min = max(m_min if m_min is not None else ensemble.m // 2, 2)
+        self.max_merge = max_merge if 'rBA' not in ensemble.filter else 0
+        self.max_window = self.max_merge + 1
+        self.safety = safety
+        self.recover_below = recover_below
+        self.smoothing = smoothing
+        self.cost = dict(forecast=None, analysis=None)
+        self.pending = []  # Merged observations (t, d) waiting for the next analysis
+        self.Nt_analysis = 0  # Time steps since the last analysis
+        self.decisions = deque(maxlen=max_decisions)
+
+    def predict(self, mode, Nt, m):
+        """ Predicted latency of a cycle of Nt time steps with m members """
+        c_f, c_a = [self.cost[key] or 0. for key in ['forecast', 'analysis']]
+        if mode == 'averaged':
+            return Nt * c_f
+        if mode in ['merge', 'skip']:
+            return Nt * m * c_f
+        return Nt * m * c_f + m * c_a * (len(self.pending) + 1)
+
+    def decide(self, Nt, available):
+        """ Mode and ensemble size of the next cycle """
+        m = self.ensemble.m
+        limit = self.safety * available
+        # The full ensemble is restored after a reduction only if there is enough headroom
+        if self.predict('full', Nt, self.m_full) <= (limit if m == self.m_full else self.recover_below * available):
+            return 'full', self.m_full
+        for m_try in range(min(m, self.m_full - 1), self.m_min - 1, -1):
+            if self.predict('reduced', Nt, m_try) <= limit:
+                return 'reduced', m_try
+        if len(self.pending) < self.max_merge and self.predict('merge', Nt, m) <= limit:
+            return 'merge', m
+        if self.predict('skip', Nt, m) <= limit:
+            return 'skip', m
+        return 'averaged', m
+
+    def update_cost(self, phase, latency, work):
+        if work <= 0:
+            return
+        cost = latency / work
+        old = self.cost[phase]
+        self.cost[phase] = cost if old is None else (1 - self.smoothing) * old + self.smoothing * cost
+
+    def process(self, t, d, arrival=None):
+        """ Process the sensor block with observation d at time t, which arrived at the clock time arrival
+            Returns:
+                decision: dictionary with the mode, ensemble size, predicted and measured latency, and whether
+                          the deadline was missed. The analysis result, if any, is in decision['result']
+        """
+        case = self.ensemble
+        start = self.clock()
+        arrival = start if arrival is None else arrival
+        available = arrival + self.budget - start
+        d = np.array(d, dtype=float)
+        case.instrumentation.new_cycle(t=float(t))
+
+        Nt = int(np.round((t - case.get_current_time) / case.dt))
+        mode, m = self.decide(Nt, available)
+        if m != case.m:
+            resizeStep(case, m)
+        decision = dict(t=float(t), mode=mode, m=case.m, available=available,
+                        predicted=self.predict(mode, Nt, case.m))
+
+        # Forecast
+        t0 = self.clock()
+        Nt = self.forecast(t, averaged=mode == 'averaged')
+        work = Nt if mode == 'averaged' else Nt * case.m
+        if hasattr(self.clock, 'spend'):
+            self.clock.spend('forecast', work)
+        self.update_cost('forecast', self.clock() - t0, work)
+        self.Nt_analysis += Nt
+
+        # Analysis, merge or skip
+        result = None
+        if mode in ['full', 'reduced']:
+            t0 = self.clock()
+            t_window, d_window = [tt for tt, _ in self.pending], [dd for _, dd in self.pending]
+            result = self.analyse(d, self.Nt_analysis, t_window=t_window, d_window=d_window)
+            work = case.m * (len(self.pending) + 1)
+            if hasattr(self.clock, 'spend'):
+                self.clock.spend('analysis', work)
+            self.update_cost('analysis', self.clock() - t0, work)
+            self.pending, self.Nt_analysis = [], 0
+        elif mode == 'merge':
+            self.pending.append((case.get_current_time, d))
+        else:
+            if self.pending:
+                decision['dropped'] = len(self.pending)
+            self.pending = []
+
+        decision['latency'] = self.clock() - start
+        decision['missed'] = self.clock() > arrival + self.budget
+        self.decisions.append(dict(decision))  # The analysis ensemble is not kept in the log
+        decision['result'] = result
+        count(case, 'mode_' + mode)
+        message = 'RT t = {:.6g}: {} with m = {}, latency {:.3g} s of {:.3g} s available{}'.format(
+            t, mode, case.m, decision['latency'], available, ' (deadline missed)' if decision['missed'] else '')
+        if mode == 'full' and not decision['missed']:
+            logger.debug(message)
+        else:
+            logger.info(message)
+        return decision
+
+    def run_realtime(self, observations, time_scale=1.):
+        """ Process the (t, d) pairs of an iterable as sensor blocks arriving in real time, i.e. the block at
+            time t arrives time_scale * (t - t_first) seconds after the first one. With a SimulatedClock,
+            the time is advanced to the arrival of the next block instead of waiting.
+        """
+        t_first, clock0 = None, self.clock()
+        for t, d in observations:
+            if t_first is None:
+                t_first = t
+            arrival = clock0 + time_scale * (t - t_first)
+            wait = arrival - self.clock()
+            if wait > 0:
+                if hasattr(self.clock, 'advance'):
+                    self.clock.advance(wait)
+                else:
+                    time.sleep(wait)
+            yield self.process(t, d, arrival=arrival)
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+class IndexOperator:
+    """ Linear operator that selects the entries idx of a state of size N, i.e. the matrix with rows of the
+        identity. M @ A is A[idx] (along the state dimension, the second to last if A is a matrix or a stack
+        of ensembles), so the mapping costs a copy of the selected rows instead of a product with zeros.
+        Numpy functions such as np.dot use the equivalent dense matrix.
+    """
+
+    __array_ufunc__ = None  # B @ M with an array B is M.__rmatmul__(B)
+
+    def __init__(self, idx, N):
+        self.idx = np.asarray(idx, dtype=int)
+        self.N = int(N)
+
+    @property
+    def shape(self):
+        return len(self.idx), self.N
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __matmul__(self, A):
+        return np.take(A, self.idx, axis=0 if np.ndim(A) == 1 else -2)
+
+    def __rmatmul__(self, B):
+        return MatrixOperator(B, inner=self)
+
+    def __getitem__(self, rows):
+        return IndexOperator(self.idx[rows], self.N)
+
+    def __array__(self, dtype=None, copy=None):
+        # Dense matrix for the numpy functions, e.g. np.dot(M, A)
+        return self.toarray().astype(dtype or float, copy=False)
+
+    def toarray(self):
+        out = np.zeros(self.shape)
+        out[np.arange(len(self.idx)), self.idx] = 1.
+        return out
+
+
+class MatrixOperator:
+    """ General linear operator matrix @ inner, where inner is an optional operator applied first (e.g. an
+        IndexOperator), so that products such as (I + J) M never form the dense matrix of size Nq x N.
+    """
+
+    __array_ufunc__ = None
+
+    def __init__(self, matrix, inner=None):
+        self.matrix = np.asarray(matrix)
+        self.inner = inner
+
+    @property
+    def shape(self):
+        return self.matrix.shape[0], self.matrix.shape[1] if self.inner is None else self.inner.shape[1]
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __matmul__(self, A):
+        if self.inner is not None:
+            A = self.inner @ A
+        return np.matmul(self.matrix, A)
+
+    def __rmatmul__(self, B):
+        return MatrixOperator(np.matmul(B, self.matrix), inner=self.inner)
+
+    def __getitem__(self, rows):
+        return MatrixOperator(self.matrix[rows], inner=self.inner)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.toarray().astype(dtype or self.matrix.dtype, copy=False)
+
+    def toarray(self):
+        if self.inner is None:
+            return self.matrix.copy()
+        return np.matmul(self.matrix, self.inner.toarray())
+
+
+def as_operator(M):
+    """ Operator of M, which may be an operator already or a dense matrix """
+    if isinstance(M, (IndexOperator, MatrixOperator)):
+        return M
+    return MatrixOperator(M)
+
+
+def stack_operators(operators):
+    """ Operator with the rows of all the operators, which must act on states of the same size. Selections are
+        stacked into one selection, and matrices applied after the same inner operator into one matrix.
+    """
+    operators = [as_operator(op) for op in operators]
+    if len(set(op.shape[1] for op in operators)) > 1:
+        raise ValueError('The operators act on states of different sizes')
+    if all(isinstance(op, IndexOperator) for op in operators):
+        return IndexOperator(np.concatenate([op.idx for op in operators]), operators[0].N)
+    if all(isinstance(op, MatrixOperator) and op.inner is operators[0].inner for op in operators):
+        return MatrixOperator(np.vstack([op.matrix for op in operators]), inner=operators[0].inner)
+    return MatrixOperator(np.vstack([op.toarray() for op in operators]))
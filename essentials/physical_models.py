@@ -8,6 +8,7 @@ import os
 
 from essentials.bias_models import NoBias
 from essentials.Util import Cheb
+from essentials.operators import IndexOperator
 
 
 from sys import platform
@@ -66,7 +67,11 @@ class Model:
                               ensure_mean=False,
                               num_DA_blind=0,
                               num_SE_only=0,
-                              start_ensemble_forecast=0.
+                              start_ensemble_forecast=0.,
+                              concurrent_bias_forecast=False,
+                              num_processes=None,
+                              obs_batch_size=1,
+                              localisation_radius=None
                               )
 
     def __init__(self, **kwargs):
@@ -190,20 +195,32 @@ class Model:
             # else:
             #     print('\t {} = {}'.format(key, val))
 
+    # ---------------------- OBSERVATION LOCATIONS ---------------------- ##
+    @property
+    def obs_locations(self):
+        """ Position of each observable, used to localise the analysis. None if the model has no geometry """
+        return None
+
+    @property
+    def state_locations(self):
+        """ Position of each state variable (NaN if global), to localise the state. None if all are global """
+        return None
+
+    @staticmethod
+    def obs_distance(loc1, loc2):
+        """ Matrix of distances between the locations loc1 and loc2 """
+        return np.abs(np.subtract.outer(loc1, loc2))
+
     # --------------------- DEFINE OBS-STATE MAP --------------------- ##
     @property
     def M(self):
-        if not hasattr(self, '_M'):
-            setattr(self, '_M', np.hstack((np.zeros([self.Nq, self.Na + self.Nphi]), np.eye(self.Nq))))
-        return self._M
+        """ Selection of the observables y from the augmented state [psi; alpha; y] """
+        return IndexOperator(np.arange(self.Nphi + self.Na, self.N), self.N)
 
     @property
     def Ma(self):
-        if not hasattr(self, '_Ma'):
-            setattr(self, '_Ma', np.hstack((np.zeros([self.Na, self.Nphi]),
-                                            np.eye(self.Na),
-                                            np.zeros([self.Na, self.Nq]))))
-        return self._Ma
+        """ Selection of the parameters alpha from the augmented state [psi; alpha; y] """
+        return IndexOperator(np.arange(self.Nphi, self.Nphi + self.Na), self.N)
 
     # ------------------------- Functions for update/initialise the model --------------------------- #
     @staticmethod
@@ -335,11 +352,15 @@ class Model:
             self._physical += 1
 
     # -------------- Functions required for the forecasting ------------------- #
+    @property
+    def num_pool_processes(self):
+        # num_processes limits the pool, e.g. when several experiments share the machine
+        return min(self.m, getattr(self, 'num_processes', None) or mp.cpu_count())
+
     @property
     def pool(self):
         if not hasattr(self, '_pool'):
-            N_pools = min(self.m, mp.cpu_count())
-            self._pool = mp.Pool(N_pools)
+            self._pool = mp.Pool(self.num_pool_processes)
         return self._pool
 
     def close(self):
@@ -350,6 +371,18 @@ class Model:
         else:
             pass
 
+    def resize_ensemble(self, W):
+        """ Change the ensemble size, with new members given by linear combinations of the current ones.
+            The weights W [m x m_new] are applied to the whole history and to the bias model.
+        """
+        N_old, self.m = self.num_pool_processes, W.shape[-1]
+        self.hist = np.matmul(self.hist, W)
+        if self.bias is not None:
+            self.bias.resize_ensemble(W)
+        # The pool is re-created with more processes if the ensemble has grown
+        if self.num_pool_processes > N_old:
+            self.close()
+
     def get_alpha(self, psi=None):
         alpha = []
         if psi is None:
@@ -380,6 +413,10 @@ class Model:
         # psi = RK4(t_interp, y0, fun, params)
         return psi
 
+    def get_forecast_times(self, Nt):
+        """ Times of the next Nt forecast steps, including the current time """
+        return np.round(self.get_current_time + np.arange(0, Nt + 1) * self.dt, self.precision_t)
+
     def time_integrate(self, Nt=100, averaged=False, alpha=None):
         """
             Integrator of the model. If the model is forcast as an ensemble, it uses parallel computation.
@@ -393,7 +430,7 @@ class Model:
                 t: time of the propagated psi
         """
 
-        t = np.round(self.get_current_time + np.arange(0, Nt + 1) * self.dt, self.precision_t)
+        t = self.get_forecast_times(Nt)
         args = self.governing_eqns_params
 
         psi0 = self.get_current_state
@@ -589,6 +626,10 @@ class Rijke(Model):
             loc = np.expand_dims(self.x_mic, axis=1)
         return ["$p'(x = {:.2f})$".format(x) for x in loc[:, 0]]
 
+    @property
+    def obs_locations(self):
+        return self.x_mic
+
     @property
     def state_labels(self):
         lbls0 = [f"$\\eta_{j}$" for j in np.arange(self.Nm)]
@@ -790,6 +831,16 @@ class Annular(Model):
                 loc = self.theta_mic
             return ["$p(\\theta={}^\\circ)$".format(int(np.round(np.degrees(th)))) for th in np.array(loc)]
 
+    @property
+    def obs_locations(self):
+        return np.array(self.theta_mic)
+
+    @staticmethod
+    def obs_distance(loc1, loc2):
+        """ Angular distance between the microphones, which is periodic around the annulus """
+        dist = np.abs(np.subtract.outer(loc1, loc2)) % (2 * np.pi)
+        return np.minimum(dist, 2 * np.pi - dist)
+
     @staticmethod
     def nu_from_ER(ER):
         return Annular.nu_1 * ER + Annular.nu_2
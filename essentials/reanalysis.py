@@ -0,0 +1,144 @@
+import os
+import shutil
+import logging
+import tempfile
+import numpy as np
+
+from essentials.DA import dataAssimilation
+from essentials.Util import save_to_pickle_file, load_from_pickle_file
+from essentials.scheduler import Task, run_tasks
+
+logger = logging.getLogger(__name__)
+
+
+def windowedReanalysis(ensemble, y_obs, t_obs, N_windows=4, N_overlap=5, std_obs=0.2, Cdd=None, Nt_extra=None,
+                       t_raw=None, y_raw=None, folder=None, cpu_budget=None, **kwargs):
+    """ Parallel-in-time reanalysis of a recorded dataset. The observations are split into N_windows
+        consecutive windows, which are assimilated concurrently by independent copies of the ensemble.
+        Each window (but the first) starts N_overlap observations early: the ensemble is moved to the
+        start of the overlap and synchronised with the data by assimilating it, and the bias model is
+        washed out with the raw record t_raw, y_raw just before the overlap. The overlap analyses are
+        discarded when the windows are stitched together, so the reanalysis at each time comes from the
+        window that owns it. The first window is the same as a sequential run, with the washout in kwargs.
+        All the windows use the same observation error covariance, defined from the whole record if Cdd
+        is not given.
+        Inputs:
+            ensemble: ensemble forecast as a class object, with the bias model already trained
+            folder: where the window results are saved. Windows already saved are not repeated. If not
+                    given, a temporary folder is used and removed after stitching
+            cpu_budget: processors shared by the windows (all the CPUs by default)
+        Returns:
+            ensemble: reanalysis, with the stitched histories of the ensemble and bias. The attribute
+                      reanalysis_windows has the (t_start, t_end] interval owned by each window
+    """
+    if cpu_budget is None:
+        cpu_budget = os.cpu_count()
+    if Cdd is None:
+        Cdd = np.diag((std_obs * np.ones(ensemble.Nq))) * np.max(abs(y_obs), axis=0) ** 2
+    ensemble.close()
+
+    # Observations owned by each window
+    owned = [idx for idx in np.array_split(np.arange(len(t_obs)), N_windows) if len(idx)]
+    if len(owned) > 1 and owned[1][0] < N_overlap:
+        raise ValueError('The first window is shorter than the overlap, reduce N_windows or N_overlap')
+
+    remove_folder = folder is None
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix='reanalysis_')
+    os.makedirs(folder, exist_ok=True)
+
+    tasks, filenames = [], []
+    for w, idx in enumerate(owned):
+        i0, i1 = max(idx[0] - N_overlap, 0), idx[-1]
+        window_kwargs = dict(kwargs)
+        if w == 0:
+            case = ensemble.copy()
+        else:
+            wash = get_window_washout(ensemble.bias, t_obs[i0], t_raw, y_raw)
+            if wash is not None:
+                window_kwargs['wash_t'], window_kwargs['wash_obs'] = wash
+            # Start one observation interval before the overlap and the washout
+            t_first = t_obs[i0] if wash is None else min(t_obs[i0], wash[0][0])
+            dt_obs = t_obs[1] - t_obs[0]
+            t_start = t_obs[i0] - np.ceil((t_obs[i0] - t_first) / dt_obs + 1) * dt_obs
+            case = move_ensemble(ensemble, t_start)
+
+        filename = os.path.join(folder, 'window_{:03d}'.format(w))
+        filenames.append(filename)
+        tasks.append(Task(name=filename, func=reanalysis_window,
+                          args=(case, y_obs[i0:i1 + 1], t_obs[i0:i1 + 1], filename),
+                          kwargs=dict(window_kwargs, std_obs=std_obs, Cdd=Cdd,
+                                      Nt_extra=Nt_extra if w == len(owned) - 1 else None,
+                                      num_processes=min(case.m, cpu_budget)),
+                          outputs=[filename], cpus=min(case.m, cpu_budget)))
+
+    status = run_tasks(tasks, cpu_budget=cpu_budget)
+    failed = [name for name, val in status.items() if val == 'failed']
+    if failed:
+        raise RuntimeError('Reanalysis windows failed: {}'.format(failed))
+
+    # Interval of time owned by each window, between the last analyses of consecutive windows
+    bounds = [-np.inf] + [t_obs[idx[-1]] for idx in owned[:-1]] + [np.inf]
+    windows = [load_from_pickle_file(filename) for filename in filenames]
+    out = stitch_windows(windows, bounds)
+    out.reanalysis_windows = list(zip(bounds[:-1], bounds[1:]))
+    out.number_of_analysis_steps = int(np.ceil(len(t_obs) / kwargs.get('obs_per_window', 1)))
+
+    if remove_folder:
+        shutil.rmtree(folder, ignore_errors=True)
+    logger.info('Reanalysis of {} windows stitched'.format(len(windows)))
+    return out
+
+
+def reanalysis_window(ensemble, y_obs, t_obs, filename, num_processes=None, **kwargs):
+    """ Assimilate the observations of one window and save the ensemble to filename """
+    ensemble.num_processes = num_processes
+    ensemble = dataAssimilation(ensemble, y_obs, t_obs, **kwargs)
+    save_to_pickle_file(filename, ensemble)
+
+
+def move_ensemble(ensemble, t_start):
+    """ Copy of the ensemble, and its bias, with only the current state, moved to time t_start """
+    case = ensemble.copy()
+    for model in [case, case.bias]:
+        if model is not None:
+            model.hist = model.hist[-1:].copy()
+            model.hist_t = np.round(model.hist_t[-1:] - model.hist_t[-1] + t_start, model.precision_t)
+    return case
+
+
+def get_window_washout(bias, t_init, t_raw, y_raw):
+    """ Washout observations of the bias model ending at t_init, from the raw record. None if the bias model
+        does not need washout.
+        Returns:
+            wash_t, wash_obs
+    """
+    if bias is None or not hasattr(bias, 'N_wash'):
+        return None
+    if t_raw is None or y_raw is None:
+        raise ValueError('The raw record t_raw, y_raw is required for the washout of the bias model')
+    i1 = np.argmin(abs(t_raw - t_init))
+    i0 = i1 - bias.N_wash * bias.upsample
+    if i0 < 0:
+        raise ValueError('Not enough raw data before t = {} for the washout'.format(t_init))
+    return t_raw[i0:i1 + 1:bias.upsample], y_raw[i0:i1 + 1:bias.upsample]
+
+
+def stitch_windows(windows, bounds):
+    """ Concatenate the histories of the windows, each in the interval (bounds[w], bounds[w + 1]] """
+    out = windows[-1]
+    for key in ['', 'bias.']:
+        hist, hist_t = [], []
+        for case, t0, t1 in zip(windows, bounds[:-1], bounds[1:]):
+            model = case.bias if key else case
+            keep = (model.hist_t > t0) & (model.hist_t <= t1)
+            hist.append(model.hist[keep])
+            hist_t.append(model.hist_t[keep])
+        model = out.bias if key else out
+        model.hist, model.hist_t = np.concatenate(hist), np.concatenate(hist_t)
+
+    rejected = [rejection for case, t0, t1 in zip(windows, bounds[:-1], bounds[1:])
+                for rejection in getattr(case, 'rejected_analysis', []) if t0 < rejection[0][0] <= t1]
+    if rejected:
+        out.rejected_analysis = rejected
+    return out
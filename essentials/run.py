@@ -1,16 +1,17 @@
 from essentials.DA import dataAssimilation
 from essentials.create import *
+from essentials.scheduler import Task, expand_sweep, run_tasks
 import numpy as np
 
 rng = np.random.default_rng(6)
 path_dir = '/'.join(os.path.realpath(__file__).split('/')[:-1]) + '/'
 
 
-def main(filter_ens, y_obs, t_obs, std_obs=0.2, wash_obs=None, wash_t=None, max_t=None):
+def main(filter_ens, y_obs, t_obs, std_obs=0.2, wash_obs=None, wash_t=None, max_t=None, Cdd=None):
 
     # =========================  PERFORM DATA ASSIMILATION ========================== #
 
-    filter_ens = dataAssimilation(filter_ens, y_obs, t_obs, std_obs=std_obs,
+    filter_ens = dataAssimilation(filter_ens, y_obs, t_obs, std_obs=std_obs, Cdd=Cdd,
                                   wash_obs=wash_obs, wash_t=wash_t)
 
     # =========================  EXTRA FORCAST POST-DA  ========================== #
@@ -39,34 +40,106 @@ def main(filter_ens, y_obs, t_obs, std_obs=0.2, wash_obs=None, wash_t=None, max_
 
 
 # ------------------------------------------------------------------------------------------------------------------- #
-def run_Lk_loop(ensemble, truth, bias_params, Ls=10, ks=1., folder=''):
-    truth = truth.copy()
+def run_Lk_loop(ensemble, truth, bias_params, Ls=10, ks=1., folder='', std_obs=0.2, ms=None, seeds=None,
+                cpu_budget=None):
+    """ Run the sweep of sweep_tasks with the experiment scheduler. Simulations already saved in
+        the folder are not repeated.
+        Returns:
+            status: dictionary with 'skipped', 'done' or 'failed' for each task of the sweep
+    """
+    tasks = sweep_tasks(ensemble, truth, bias_params, Ls=Ls, ks=ks, folder=folder, std_obs=std_obs,
+                        ms=ms, seeds=seeds, cpu_budget=cpu_budget)
+    return run_tasks(tasks, cpu_budget=cpu_budget)
+
+
+def sweep_tasks(ensemble, truth, bias_params, Ls=10, ks=1., folder='', std_obs=0.2, ms=None, seeds=None,
+                cpu_budget=None):
+    """ Expand a sweep over the bias model sizes Ls, regularization factors ks, ensemble sizes ms and
+        ensemble seeds into a graph of tasks: one bias model is trained per L, saved with the name of the truth
+        so that the sweeps of several truths do not share it, and it is used in the
+        assimilation of each (k, m, seed) combination. The simulations are saved in
+        folder/[m{m}/][seed{seed}/]L{L}/, and the error metrics of each (m, seed) are computed once all its
+        simulations are saved. Task lists of several sweeps (e.g. one per truth, each in its own folder) can
+        be run together.
+        Returns:
+            tasks: list of scheduler Tasks
+    """
+    if cpu_budget is None:
+        cpu_budget = os.cpu_count()
     bias_params = bias_params.copy()
-    if type(Ls) is int:
-        Ls = [Ls]
-    if type(ks) is float:
-        ks = [ks]
-
-    for L in Ls:  # LOOP OVER Ls
-        blank_ens = ensemble.copy()
-        # Reset ESN
-        bias_params['L'] = L
-        bias_name = 'ESN_L{}'.format(bias_params['L'])
-        create_bias_model(blank_ens, truth, bias_params, bias_name,
-                          bias_model_folder=folder, plot_train_data=False)
-        results_folder = folder + 'L{}/'.format(L)
-        for k in ks:
-            filter_ens = blank_ens.copy()
-            filter_ens.regularization_factor = k  # Reset regularization value
-            # ------------------ RUN & SAVE SIMULATION  -------------------
-            filter_ens = main(filter_ens, truth)
-            save_simulation(filter_ens, truth, results_dir=results_folder)
-
-
-#
+    bias_params.setdefault('plot_train_dataset', False)
+
+    tasks = []
+    for L in expand_sweep(L=Ls):
+        L = L['L']
+        bias_filename = 'ESN_{}_L{}'.format(truth['name'], L)
+        tasks.append(Task(name=folder + bias_filename, func=train_bias_task,
+                          args=(ensemble, truth, dict(bias_params, L=L), bias_filename, folder),
+                          outputs=[folder + bias_filename], cpus=min(L, os.cpu_count())))
+
+    for group in expand_sweep(m=ms, seed=seeds):
+        group_folder = folder + ''.join('{}{}/'.format(key, val) for key, val in group.items() if val is not None)
+        m = group['m'] if group['m'] is not None else ensemble.m
+        saved = []
+        for point in expand_sweep(L=Ls, k=ks):
+            results_dir = group_folder + 'L{}/'.format(point['L'])
+            k = point['k'] if point['k'] is not None else getattr(ensemble, 'regularization_factor', None)
+            filename = simulation_filename(ensemble.filter, truth['name'], ensemble.name, k, results_dir)
+            bias_file = folder + 'ESN_{}_L{}'.format(truth['name'], point['L'])
+            saved.append(filename)
+            tasks.append(Task(name=filename, func=assimilate_task,
+                              args=(ensemble, truth, bias_file, results_dir),
+                              kwargs=dict(point, std_obs=std_obs, num_processes=min(m, cpu_budget), **group),
+                              deps=[bias_file],
+                              outputs=[filename], cpus=min(m, cpu_budget)))
+
+        tasks.append(Task(name=group_folder + 'CR_data', func=get_error_metrics, args=(group_folder,),
+                          deps=saved, outputs=[group_folder + 'CR_data']))
+    return tasks
+
+
+def train_bias_task(ensemble, truth, bias_params, bias_filename, folder):
+    """ Train the bias model and save it, with its washout, to folder + bias_filename. The training data
+        ensemble of L members is forecast on a pool of min(L, cpu_count) processes.
+    """
+    create_bias_model(ensemble, bias_params, truth, bias_filename=bias_filename, folder=folder)
+
+
+def assimilate_task(ensemble, truth, bias_file, results_dir, L=None, k=None, m=None, seed=None, std_obs=0.2,
+                    num_processes=None):
+    """ Assimilate the truth with a copy of the ensemble, re-initialised with m members and the seed if given,
+        and the bias model saved in bias_file. The simulation is saved in results_dir.
+    """
+    filter_ens = ensemble.copy()
+    if m is not None or seed is not None:
+        settings = {key: getattr(filter_ens, key) for key in filter_ens.defaults_ens.keys()}
+        if m is not None:
+            settings['m'] = m
+        # Re-draw the ensemble about the mean of the current state
+        mean_psi0 = np.mean(filter_ens.get_current_state[:filter_ens.Nphi], -1, keepdims=True)
+        filter_ens.update_history(psi=mean_psi0, t=filter_ens.hist_t[-1:], reset=True)
+        filter_ens.init_ensemble(seed=seed, **settings)
+
+    filter_ens.num_processes = num_processes
+    filter_ens.bias, wash_obs, wash_t = load_from_pickle_file(bias_file)
+    if k is not None:
+        filter_ens.regularization_factor = k
+
+    filter_ens = main(filter_ens, truth['y_obs'], truth['t_obs'], std_obs=std_obs, wash_obs=wash_obs, wash_t=wash_t,
+                      Cdd=truth.get('Cdd'))
+    save_simulation(filter_ens, truth, extra_parameters=dict(L=L, m=filter_ens.m, seed=seed),
+                    results_dir=results_dir)
+
 
 # ------------------------------------------------------------------------------------------------------------------- #
 
+def simulation_filename(filter_name, truth_name, model_name, k=None, results_dir="results/"):
+    filename = '{}{}-{}_F-{}'.format(results_dir, filter_name, truth_name, model_name)
+    if k is not None:
+        filename += '_k{}'.format(k)
+    return filename
+
+
 def save_simulation(filter_ens, truth, extra_parameters=None, results_dir="results/"):
     os.makedirs(results_dir, exist_ok=True)
 
@@ -77,8 +150,7 @@ def save_simulation(filter_ens, truth, extra_parameters=None, results_dir="resul
         for key, val in extra_parameters.items():
             parameters[key] = val
     # =============================== SAVE SIMULATION  =============================== #
-    filename = '{}{}-{}_F-{}'.format(results_dir, filter_ens.filter, truth['name'], filter_ens.name)
-    if hasattr(filter_ens, 'regularization_factor'):
-        filename += '_k{}'.format(filter_ens.regularization_factor)
+    filename = simulation_filename(filter_ens.filter, truth['name'], filter_ens.name,
+                                   getattr(filter_ens, 'regularization_factor', None), results_dir)
     # save simulation
     save_to_pickle_file(filename, parameters, truth, filter_ens)
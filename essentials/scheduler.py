@@ -0,0 +1,116 @@
+import os
+import time
+import logging
+import itertools
+import numpy as np
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+
+class Task:
+    """ A unit of work of an experiment: func(*args, **kwargs) is run in a worker process once all the tasks
+        named in deps have finished. Tasks exchange data through files, so the task is skipped if all its
+        outputs already exist. cpus is the number of processors the task uses (e.g. the size of the
+        ensemble pool), which is charged against the budget of the scheduler while it runs.
+    """
+
+    def __init__(self, name, func, args=(), kwargs=None, deps=(), outputs=(), cpus=1):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs) if kwargs is not None else dict()
+        self.deps = list(deps)
+        self.outputs = list(outputs)
+        self.cpus = max(int(cpus), 1)
+
+    def is_done(self):
+        return len(self.outputs) > 0 and all(os.path.exists(f) for f in self.outputs)
+
+    def __repr__(self):
+        return 'Task({})'.format(self.name)
+
+
+def expand_sweep(**axes):
+    """ Cartesian product of the sweep axes, e.g. expand_sweep(L=[10, 50], k=[0., 1.]).
+        Scalars are treated as axes of length one.
+        Returns:
+            list of dictionaries, one per combination, with the last axis varying fastest
+    """
+    keys = list(axes.keys())
+    values = [list(val) if isinstance(val, (list, tuple, range)) or np.ndim(val) > 0 else [val]
+              for val in axes.values()]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def run_tasks(tasks, cpu_budget=None):
+    """ Run a graph of tasks on a process pool. A task starts as soon as its dependencies have finished and
+        the processors in use, counting its own cpus, fit in cpu_budget (all the CPUs by default). A task
+        that needs more than the budget runs on its own. Tasks whose outputs exist are skipped, so an
+        interrupted sweep is resumed by running it again. If a task fails, the tasks that depend on it are
+        not run, but the rest of the graph is completed. Task names must be unique.
+        Returns:
+            status: dictionary with 'skipped', 'done' or 'failed' for each task name
+    """
+    if cpu_budget is None:
+        cpu_budget = os.cpu_count()
+    duplicated = sorted(name for name, count in Counter(task.name for task in tasks).items() if count > 1)
+    if duplicated:
+        raise ValueError('Tasks with duplicated names {}'.format(duplicated))
+    tasks = {task.name: task for task in tasks}
+    for task in tasks.values():
+        missing = [dep for dep in task.deps if dep not in tasks]
+        if missing:
+            raise ValueError('Task {} depends on unknown tasks {}'.format(task.name, missing))
+
+    status = dict()
+    for name, task in tasks.items():
+        if task.is_done():
+            status[name] = 'skipped'
+    pending = [name for name in tasks if name not in status]
+    logger.info('Running {} tasks ({} skipped) with {} CPUs'.format(len(pending), len(status), cpu_budget))
+
+    running, cpus_in_use = dict(), 0
+    with ProcessPoolExecutor(max_workers=cpu_budget) as executor:
+        while pending or running:
+            # Tasks downstream of a failure are not run
+            blocked = True
+            while blocked:
+                blocked = [name for name in pending if any(status.get(dep) == 'failed' for dep in tasks[name].deps)]
+                for name in blocked:
+                    status[name] = 'failed'
+                    pending.remove(name)
+                    logger.info('Not running {}: a dependency failed'.format(name))
+
+            # Launch the ready tasks that fit in the budget, in order
+            for name in list(pending):
+                task = tasks[name]
+                if not all(status.get(dep) in ('done', 'skipped') for dep in task.deps):
+                    continue
+                if running and cpus_in_use + task.cpus > cpu_budget:
+                    continue
+                future = executor.submit(task.func, *task.args, **task.kwargs)
+                running[future] = (name, time.perf_counter())
+                cpus_in_use += task.cpus
+                pending.remove(name)
+
+            if not running:
+                if pending:
+                    raise RuntimeError('Tasks {} can not be run, check for cycles in the dependencies'.format(pending))
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, t0 = running.pop(future)
+                cpus_in_use -= tasks[name].cpus
+                if future.exception() is not None:
+                    status[name] = 'failed'
+                    logger.error('Task {} failed: {!r}'.format(name, future.exception()))
+                else:
+                    status[name] = 'done'
+                    logger.info('Task {} done in {:.1f} s'.format(name, time.perf_counter() - t0))
+                    if not tasks[name].is_done() and tasks[name].outputs:
+                        logger.warning('Task {} did not write all its outputs'.format(name))
+
+    return status
@@ -1,3 +1,4 @@
+import logging
 from essentials.physical_models import Lorenz63
 from essentials.bias_models import *
 from essentials.run import main
@@ -34,6 +35,7 @@ true_params = {'model': Lorenz63,
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     # ================================================================================== #
     ensemble = create_ensemble(forecast_params, **filter_params)
     truth = create_truth(**true_params, **filter_params)
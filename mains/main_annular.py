@@ -1,3 +1,4 @@
+import logging
 from default_parameters.lorenz63 import bias_params
 from essentials.DA import *
 from essentials.create import *
@@ -53,6 +54,7 @@ train_params = dict(bias_model=ESN,
 data_folder, results_folder, figs_folder = set_working_directories('annular')
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
 
     for m in [20]:
     # for m in [10, 20, 40, 60, 80]: